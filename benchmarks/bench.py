@@ -0,0 +1,253 @@
+"""End to end timings of mkcross, offline against local fixture sources.
+
+	python benchmarks/bench.py seed [triple ...]      # once, with network
+	python benchmarks/bench.py run [options] [triple ...] [-- mkcross arguments]
+
+seed downloads the sources every triple needs into benchmarks/fixtures/files
+and pins their versions in benchmarks/fixtures/versions.json. run serves those
+over HTTP on localhost and times, for each triple:
+
+	cold           nothing downloaded, extracted or built
+	warm-download  sources downloaded, nothing extracted or built
+	warm-build     everything there from the last run, nothing to do
+
+Every other address goes through a proxy that isn't there, so a run that would
+need the network fails instead of quietly measuring it.
+
+Options of run:
+	--repeat=N       runs per scenario, the median is reported (1)
+	--output=PATH    results JSON (benchmarks/results.json)
+	--baseline=PATH  results to compare to (benchmarks/baseline.json)
+	--threshold=F    slowdown over the baseline that counts as a regression (0.10)
+	--min-delta=S    and the seconds it has to be slower by, for noisy short scenarios (1.0)
+	--update-baseline  store the results as the new baseline
+
+Exits with 1 if any scenario regressed.
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import fixture_server
+
+HERE = Path(__file__).parent.resolve()
+REPO = HERE.parent
+FIXTURES = HERE / "fixtures"
+WORK = HERE / "work"
+
+# musl, mingw, baremetal and wasix
+TRIPLES = ["aarch64-linux-musl", "x86_64-w64-mingw32", "armv7m-unknown-none-eabi", "wasm32-wasix-wasi"]
+SCENARIOS = ["cold", "warm-download", "warm-build"]
+# What mkcross creates in its working directory, see mkcross.cfg
+DIRS = ["dist", "srcs", "build", "out", "cache"]
+
+
+def mkcross_env() -> dict:
+	env = dict(os.environ)
+	env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(REPO), env.get("PYTHONPATH")]))
+	# The user's cache would make cold runs warm
+	env["MKCROSS_CACHE_DIR"] = "cache"
+	# Nothing is listening on port 9, anything but the fixture server fails right away
+	for var in ("http_proxy", "https_proxy", "HTTP_PROXY", "HTTPS_PROXY", "ALL_PROXY", "all_proxy"):
+		env[var] = "http://127.0.0.1:9"
+	env["no_proxy"] = env["NO_PROXY"] = "127.0.0.1,localhost"
+	return env
+
+
+def seed(triples: List[str]):
+	"""Download what the triples need and pin it as the fixtures."""
+	seeddir = WORK / "seed"
+	seeddir.mkdir(parents=True, exist_ok=True)
+	files = FIXTURES / "files"
+	files.mkdir(parents=True, exist_ok=True)
+	lockfile = FIXTURES / "versions.json"
+
+	# mkcross.cfg puts its directories in the working directory when imported
+	os.chdir(seeddir)
+	os.environ["MKCROSS_CACHE_DIR"] = "cache"
+	sys.path.insert(0, str(REPO))
+	from mkcross import cfg
+	from mkcross.cli import target_for_cli
+	from mkcross.helper import latest_version
+	from mkcross.packages import content_store
+
+	latest_version.setup(cfg.cachepath / "versions.json", 0, lockfile)
+	manifest = {}
+	for triple in triples:
+		for pkg in target_for_cli(triple).get_packages_list():
+			for file in pkg.files.values():
+				dl = file.downloader
+				if dl is None:
+					continue
+				dl.download()
+				path = content_store.lookup(dl.url)
+				shutil.copyfile(path, files / dl.filename)
+				manifest[dl.filename] = {"url": dl.url, "sha256": path.name}
+
+	latest_version.write_lockfile(lockfile)
+	with open(FIXTURES / "manifest.json", "w") as f:
+		json.dump(manifest, f, indent=1, sort_keys=True)
+	print(f"{len(manifest)} files in {files}, versions pinned in {lockfile}")
+
+
+def run_mkcross(workdir: Path, triple: str, scenario: str, mirror: str, extra: List[str]) -> dict:
+	trace = workdir / f"trace-{scenario}.json"
+	cmd = [sys.executable, "-m", "mkcross.cli", f"--mirror={mirror}", f"--lockfile={FIXTURES / 'versions.json'}", f"--trace={trace}", *extra, f"--target={triple}"]
+	log = workdir / f"{scenario}.log"
+	start = time.perf_counter()
+	with open(log, "w") as f:
+		proc = subprocess.run(cmd, cwd=workdir, env=mkcross_env(), stdout=f, stderr=subprocess.STDOUT)
+	seconds = time.perf_counter() - start
+	if proc.returncode != 0:
+		raise RuntimeError(f"{triple} {scenario} failed, see {log}")
+
+	# Where the time went, from the trace mkcross wrote
+	categories: Dict[str, float] = {}
+	with open(trace) as f:
+		for event in json.load(f)["traceEvents"]:
+			if event["ph"] == "X" and event["cat"] not in ("target", "task"):
+				categories[event["cat"]] = categories.get(event["cat"], 0) + event["dur"] / 1e6
+	return {"seconds": seconds, "categories": categories}
+
+
+def reset(workdir: Path, keep: List[str]):
+	for name in DIRS:
+		if name not in keep:
+			shutil.rmtree(workdir / name, ignore_errors=True)
+
+
+def bench(triple: str, repeat: int, mirror: str, extra: List[str]) -> Dict[str, dict]:
+	workdir = WORK / triple
+	runs: Dict[str, List[dict]] = {scenario: [] for scenario in SCENARIOS}
+	for _ in range(repeat):
+		reset(workdir, keep=[])
+		workdir.mkdir(parents=True, exist_ok=True)
+		runs["cold"] += [run_mkcross(workdir, triple, "cold", mirror, extra)]
+		reset(workdir, keep=["dist"])
+		runs["warm-download"] += [run_mkcross(workdir, triple, "warm-download", mirror, extra)]
+		runs["warm-build"] += [run_mkcross(workdir, triple, "warm-build", mirror, extra)]
+
+	results = {}
+	for scenario, scenario_runs in runs.items():
+		seconds = [r["seconds"] for r in scenario_runs]
+		median = statistics.median(seconds)
+		results[scenario] = {
+			"seconds": median,
+			"runs": seconds,
+			# Of the run closest to the median
+			"categories": min(scenario_runs, key=lambda r: abs(r["seconds"] - median))["categories"],
+		}
+		print(f"{triple:<24} {scenario:<14} {median:>8.1f}s")
+	return results
+
+
+def machine() -> dict:
+	clang = []
+	if shutil.which("clang") is not None:
+		clang = subprocess.run(["clang", "--version"], capture_output=True, text=True).stdout.splitlines()
+	return {
+		"host": platform.node(),
+		"cpus": os.cpu_count(),
+		"python": platform.python_version(),
+		"clang": clang[0] if clang else None,
+		"commit": subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, capture_output=True, text=True).stdout.strip(),
+	}
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_delta: float) -> List[str]:
+	"""Scenarios slower than the baseline by more than threshold and min_delta seconds."""
+	regressions = []
+	if baseline["machine"].get("host") != results["machine"]["host"]:
+		print(f"[W] The baseline is from {baseline['machine'].get('host')}, timings may not compare")
+	for triple, scenarios in results["results"].items():
+		for scenario, result in scenarios.items():
+			base = baseline["results"].get(triple, {}).get(scenario)
+			if base is None:
+				continue
+			delta = result["seconds"] - base["seconds"]
+			change = delta / base["seconds"] if base["seconds"] else 0
+			mark = ""
+			if change > threshold and delta > min_delta:
+				mark = "  REGRESSION"
+				regressions += [f"{triple} {scenario}"]
+			print(f"{triple:<24} {scenario:<14} {base['seconds']:>8.1f}s -> {result['seconds']:>8.1f}s {change:>+7.1%}{mark}")
+	return regressions
+
+
+def main():
+	args = sys.argv[1:]
+	command = args.pop(0) if args[:1] in (["seed"], ["run"]) else "run"
+	extra = []
+	if "--" in args:
+		extra = args[args.index("--") + 1:]
+		args = args[:args.index("--")]
+
+	repeat = 1
+	output = HERE / "results.json"
+	baseline_path = HERE / "baseline.json"
+	threshold = 0.10
+	min_delta = 1.0
+	update_baseline = False
+	triples = []
+	for arg in args:
+		if not arg.startswith("--"):
+			triples += [arg]
+			continue
+		argname, _, argvalue = arg.partition("=")
+		if argname == "--repeat":
+			repeat = int(argvalue)
+		elif argname == "--output":
+			output = Path(argvalue)
+		elif argname == "--baseline":
+			baseline_path = Path(argvalue)
+		elif argname == "--threshold":
+			threshold = float(argvalue)
+		elif argname == "--min-delta":
+			min_delta = float(argvalue)
+		elif argname == "--update-baseline":
+			update_baseline = True
+		else:
+			raise ValueError(f"Unknown option {arg}")
+	triples = triples or TRIPLES
+
+	if command == "seed":
+		seed(triples)
+		return
+	if not (FIXTURES / "versions.json").exists():
+		raise FileNotFoundError("No fixtures, run `python benchmarks/bench.py seed` once with network access")
+
+	server = fixture_server.start(FIXTURES / "files")
+	mirror = f"http://127.0.0.1:{server.server_port}/"
+	try:
+		results = {"machine": machine(), "results": {triple: bench(triple, repeat, mirror, extra) for triple in triples}}
+	finally:
+		server.shutdown()
+
+	with open(output, "w") as f:
+		json.dump(results, f, indent=1)
+	print(f"Results written to {output}")
+
+	if update_baseline:
+		shutil.copyfile(output, baseline_path)
+		print("Baseline updated")
+		return
+	if not baseline_path.exists():
+		print(f"No baseline at {baseline_path}, nothing to compare to")
+		return
+
+	with open(baseline_path) as f:
+		regressions = compare(results, json.load(f), threshold, min_delta)
+	if regressions:
+		print("Regressed: " + ", ".join(regressions))
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
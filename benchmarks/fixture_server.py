@@ -0,0 +1,94 @@
+"""Static file server with Range support, serving the benchmark fixtures.
+
+python benchmarks/fixture_server.py [--port=8081] [--root=benchmarks/fixtures/files]
+"""
+import os
+import re
+import sys
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+	"""GET and HEAD of files in the root, honouring single byte ranges like a CDN would."""
+
+	def log_message(self, format, *args):
+		pass
+
+	def send_head(self):
+		path = Path(self.translate_path(self.path))
+		if not path.is_file():
+			self.send_error(404)
+			return None
+		handle = open(path, "rb")
+		size = os.fstat(handle.fileno()).st_size
+		start, end = 0, size - 1
+
+		m = _RANGE.match(self.headers.get("Range", ""))
+		if m is not None and (m[1] or m[2]):
+			if m[1]:
+				start = int(m[1])
+				end = min(int(m[2]), size - 1) if m[2] else size - 1
+			else:
+				# bytes=-N, the last N bytes
+				start = max(size - int(m[2]), 0)
+			if start > end:
+				handle.close()
+				self.send_response(416)
+				self.send_header("Content-Range", f"bytes */{size}")
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+				return None
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+		else:
+			self.send_response(200)
+
+		self.send_header("Content-Type", "application/octet-stream")
+		self.send_header("Content-Length", str(end + 1 - start))
+		self.send_header("Accept-Ranges", "bytes")
+		self.end_headers()
+		handle.seek(start)
+		self._remaining = end + 1 - start
+		return handle
+
+	def copyfile(self, source, outputfile):
+		while self._remaining > 0:
+			data = source.read(min(self._remaining, 1 << 20))
+			if not data:
+				break
+			outputfile.write(data)
+			self._remaining -= len(data)
+
+
+def start(root: Path, port: int = 0) -> ThreadingHTTPServer:
+	"""Serve root on localhost from a background thread. Port 0 picks a free one, see server_port."""
+	handler = lambda *args, **kwargs: FixtureHandler(*args, directory=str(root), **kwargs)
+	server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+	threading.Thread(target=server.serve_forever, name="fixture-server", daemon=True).start()
+	return server
+
+
+def main():
+	port = 8081
+	root = Path(__file__).parent / "fixtures" / "files"
+	for arg in sys.argv[1:]:
+		argname, argvalue = arg.split("=", 1)
+		if argname == "--port":
+			port = int(argvalue)
+		elif argname == "--root":
+			root = Path(argvalue)
+
+	server = start(root, port)
+	print(f"Serving {root} on http://127.0.0.1:{server.server_port}/")
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		server.shutdown()
+
+
+if __name__ == "__main__":
+	main()
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 import pathlib
 
 # TODO move mkdir to cli parser?
@@ -10,5 +11,54 @@ buildpath = pathlib.Path("./build").resolve()
 buildpath.mkdir(parents=True, exist_ok=True)
 outputpath = pathlib.Path("./out").resolve()
 outputpath.mkdir(parents=True, exist_ok=True)
+# Shared by every output directory of the user, so what one built the others can reuse.
+# MKCROSS_CACHE_DIR overrides it, eg for a cache per output directory.
+_user_cache = pathlib.Path(os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache")
+cachepath = pathlib.Path(os.environ.get("MKCROSS_CACHE_DIR") or _user_cache / "mkcross").resolve()
+cachepath.mkdir(parents=True, exist_ok=True)
 
-makeopts = [f"-j{multiprocessing.cpu_count() + 1}"]
+# Build jobs across everything mkcross runs, unless we inherit a jobserver from make
+jobs = multiprocessing.cpu_count() + 1
+# The jobserver in MAKEFLAGS sets -j, don't add any here
+makeopts = []
+
+# Concurrent downloads for the prefetcher
+download_jobs = 4
+# Connections per download, for large files from servers that support ranges
+download_segments = 4
+# Threads writing out extracted files, and archives extracted at once
+extract_jobs = multiprocessing.cpu_count()
+# Extract sources while they download instead of after
+stream_extract = False
+# Targets built at the same time
+target_jobs = 1
+# Package stages of a target run at the same time, the jobserver limits the actual work
+stage_jobs = multiprocessing.cpu_count()
+# Build libunwind, libc++abi and libc++ with one configure, targets can override with combined_runtimes=
+combined_runtimes = False
+# Seed CMake configures with try-compile results of earlier ones
+cmake_check_cache = True
+# Share a config.cache between autoconf configures of the same host and flags
+autoconf_cache = True
+# Say why each stage that isn't up to date runs
+explain = False
+# Keep the installed files of built packages and restore them instead of building again
+artifact_cache = False
+# Least recently used artifacts go once the cache is bigger than this, in bytes
+artifact_cache_size = 10 << 30
+# Base url of a shared artifact cache (see mkcross.helper.cache_server), needs artifact_cache
+remote_cache = None
+# Upload what was built here to the remote cache
+remote_cache_push = True
+# Compiler cache to run clang through, eg ccache or sccache
+compiler_launcher = None
+# Hardlink identical installed files of every sysroot to one copy in the cache
+dedup = False
+# Seconds a looked up latest version is trusted, 0 to always look it up
+version_ttl = 24 * 60 * 60
+# Versions resolved by earlier runs, used instead of looking them up and updated with new ones
+lockfile = None
+# (upstream url prefix, mirror url or directory) pairs, tried before upstream; * matches any url by file name
+mirrors = []
+# Chrome trace of where the time went, for ui.perfetto.dev, None for none
+trace = buildpath / "trace.json"
@@ -1,6 +1,17 @@
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
 import llvmtarget
+from mkcross import cfg
+from mkcross.helper import accounting, jobserver, latest_version, launcher, mirrors, remote_cache, trace
+from mkcross.helper.flags import parse_bool, parse_size
+from mkcross.helper.output import log, target_output
 from mkcross.targets import UnixTarget
+from mkcross.helper.dedup import DEDUP_MARKER
+from mkcross.packages import Prefetcher, dedup_store
+from mkcross.scheduler import link_dependencies
 
 import re
 
@@ -28,27 +39,164 @@ def target_for_cli(arg: str):
 	return t
 
 
+def make_target_logged(target):
+	logfile = cfg.buildpath / (target.triple_nonnormalized + ".log")
+	with target_output(target.triple_nonnormalized, logfile):
+		log("Build output is in", logfile)
+		try:
+			target.make()
+		except BaseException:
+			log("[E] Failed, see", logfile)
+			raise
+		log("Done")
+
+
+def make_concurrently(targets):
+	with ThreadPoolExecutor(max_workers=cfg.target_jobs, thread_name_prefix="target") as executor:
+		futures = [executor.submit(make_target_logged, target) for target in targets]
+		# Let the other targets finish before reporting the first failure
+		wait(futures)
+		for future in futures:
+			future.result()
+
+
 def usage():
 	print("Usage: " + sys.argv[0] + " [global arguments] target [target arguments] [target 2 [target 2 arguments] ... ]")
+	print("       " + sys.argv[0] + " dedup [sysroot ...]")
+
+
+def dedup(paths):
+	"""Hardlink identical files of existing sysroots (all of them by default) to the dedup store."""
+	sysroots = [Path(path) for path in paths] or sorted(path for path in cfg.outputpath.iterdir() if path.is_dir())
+	total = 0
+	for sysroot in sysroots:
+		# The toolchain files are rewritten in place
+		files, saved = dedup_store.add_tree(sysroot, exclude=("etc/mkcross",), jobs=cfg.extract_jobs)
+		(sysroot / DEDUP_MARKER).parent.mkdir(parents=True, exist_ok=True)
+		(sysroot / DEDUP_MARKER).touch()
+		log(f"{sysroot}: {files} files hashed, {saved / (1 << 20):.1f} MiB saved")
+		total += saved
+
+	freed = dedup_store.prune()
+	log(f"Saved {total / (1 << 20):.1f} MiB, removed {freed / (1 << 20):.1f} MiB of unused objects")
 
 def main():
-	targets = []
+	if args[:1] == ["dedup"]:
+		dedup(args[1:])
+		return
+
+	target_args = []
 
 	for arg in args:
 		if not arg.startswith("--") or arg.count('=') < 1:
 			raise ValueError("Only arguments in the form of --foo=bar are supported.")
 
 		argname, argvalue = arg.split('=', 1)
-		if len(argvalue) == 0:
-			raise ValueError("Target not specified!")
 		if argname == "--target":
-			targets += [target_for_cli(argvalue)]
-
-	if len(targets) == 0:
+			if len(argvalue) == 0:
+				raise ValueError("Target not specified!")
+			target_args += [argvalue]
+		elif argname == "--download-jobs":
+			cfg.download_jobs = int(argvalue)
+		elif argname == "--download-segments":
+			cfg.download_segments = int(argvalue)
+		elif argname == "--stream-extract":
+			cfg.stream_extract = parse_bool(argvalue)
+		elif argname == "--target-jobs":
+			cfg.target_jobs = int(argvalue)
+		elif argname == "--jobs":
+			cfg.jobs = int(argvalue)
+		elif argname == "--combined-runtimes":
+			cfg.combined_runtimes = parse_bool(argvalue)
+		elif argname == "--cmake-check-cache":
+			cfg.cmake_check_cache = parse_bool(argvalue)
+		elif argname == "--autoconf-cache":
+			cfg.autoconf_cache = parse_bool(argvalue)
+		elif argname == "--explain":
+			cfg.explain = parse_bool(argvalue)
+		elif argname == "--artifact-cache":
+			cfg.artifact_cache = parse_bool(argvalue)
+		elif argname == "--artifact-cache-size":
+			cfg.artifact_cache_size = parse_size(argvalue)
+		elif argname == "--remote-cache":
+			cfg.remote_cache = argvalue
+			# Pulled artifacts go through the local cache
+			cfg.artifact_cache = True
+		elif argname == "--remote-cache-push":
+			cfg.remote_cache_push = parse_bool(argvalue)
+		elif argname == "--compiler-launcher":
+			cfg.compiler_launcher = argvalue
+		elif argname == "--dedup":
+			cfg.dedup = parse_bool(argvalue)
+		elif argname == "--version-ttl":
+			cfg.version_ttl = float(argvalue)
+		elif argname == "--lockfile":
+			cfg.lockfile = Path(argvalue)
+		elif argname == "--mirror":
+			# --mirror=https://ftp.gnu.org/gnu/=https://mirror.example/gnu/, repeatable
+			upstream, sep, mirror = argvalue.partition("=")
+			if not sep:
+				upstream, mirror = "*", argvalue
+			cfg.mirrors += [(upstream, mirror)]
+		elif argname == "--trace":
+			cfg.trace = Path(argvalue) if argvalue else None
+
+	if len(target_args) == 0:
 		raise ValueError("No targets specified!")
-
-	for target in targets:
-		target.make()
+	if cfg.dedup:
+		# Staging directories and sysroots are linked to the store, before anything is built
+		dedup_store.check_filesystem(cfg.buildpath)
+		dedup_store.check_filesystem(cfg.outputpath)
+
+	trace.setup()
+	accounting.setup()
+	jobserver.setup(cfg.jobs)
+	latest_version.setup(cfg.cachepath / "versions.json", cfg.version_ttl, cfg.lockfile)
+	mirrors.setup(cfg.mirrors, cfg.cachepath / "mirrors.json")
+	if cfg.remote_cache is not None:
+		remote_cache.setup(cfg.remote_cache, cfg.download_jobs, cfg.remote_cache_push)
+	if cfg.compiler_launcher is not None:
+		# Everything mkcross builds with is under here, so paths are relative to it in the compiler cache
+		basedir = os.path.commonpath([cfg.outputpath, cfg.srcpath, cfg.buildpath])
+		launcher.setup(cfg.compiler_launcher, Path(basedir))
+
+	# Global arguments can come after the targets, so only create them now.
+	targets = [target_for_cli(arg) for arg in target_args]
+
+	sysroots = [target.sysroot for target in targets]
+	if len(set(sysroots)) != len(sysroots):
+		raise ValueError("The same target is specified more than once!")
+
+	# Start every download now so they overlap with the builds.
+	prefetcher = Prefetcher()
+	failed = True
+	try:
+		for target in targets:
+			packages = target.get_packages_list()
+			link_dependencies(packages)
+			prefetcher.prefetch(packages)
+
+		# Every version is resolved by now
+		if cfg.lockfile is not None:
+			latest_version.write_lockfile(cfg.lockfile)
+
+		if cfg.target_jobs == 1 or len(targets) == 1:
+			for target in targets:
+				target.make()
+		else:
+			make_concurrently(targets)
+		failed = False
+	finally:
+		# After a failure or ^C, don't wait for downloads nothing will use
+		prefetcher.shutdown(cancel=failed)
+		if remote_cache.active is not None:
+			remote_cache.active.shutdown()
+
+		for line in trace.active.summary() + accounting.active.report():
+			log(line)
+		if cfg.trace is not None:
+			trace.active.write(cfg.trace)
+			log("Trace written to", cfg.trace, "(open in ui.perfetto.dev)")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+# Which package and stage the processes run in this context belong to, see stage()
+_stage: ContextVar[Tuple[str, str]] = ContextVar("stage", default=("-", "-"))
+
+
+class Usage:
+	"""Resources used by one or more processes, including their children."""
+	processes: int
+	# Seconds from start to exit, summed over processes
+	wall: float
+	user: float
+	system: float
+	# Peak resident set size of the largest process, in bytes
+	maxrss: int
+	# Bytes read from and written to storage, rather than the page cache
+	read_bytes: int
+	write_bytes: int
+
+	def __init__(self, processes=0, wall=0.0, user=0.0, system=0.0, maxrss=0, read_bytes=0, write_bytes=0):
+		self.processes = processes
+		self.wall = wall
+		self.user = user
+		self.system = system
+		self.maxrss = maxrss
+		self.read_bytes = read_bytes
+		self.write_bytes = write_bytes
+
+	def add(self, other: "Usage"):
+		self.processes += other.processes
+		self.wall += other.wall
+		self.user += other.user
+		self.system += other.system
+		self.maxrss = max(self.maxrss, other.maxrss)
+		self.read_bytes += other.read_bytes
+		self.write_bytes += other.write_bytes
+
+	@property
+	def cpu(self) -> float:
+		return self.user + self.system
+
+	@property
+	def utilisation(self) -> float:
+		"""CPUs kept busy on average, about 1 for a serial stage."""
+		return self.cpu / self.wall if self.wall > 0 else 0.0
+
+
+def _read_io(pid: int) -> Optional[Dict[str, int]]:
+	try:
+		with open(f"/proc/{pid}/io") as f:
+			return {name: int(value) for name, value in (line.split(":") for line in f)}
+	except (OSError, ValueError):
+		return None
+
+
+def wait(proc: subprocess.Popen, start: float) -> Usage:
+	"""Reap proc with wait4(), measuring what it and the children it waited for used.
+
+	start is time.monotonic() from before proc was started.
+	"""
+	io = None
+	if hasattr(os, "waitid"):
+		# Exited but not reaped, so its I/O counters (children included) are still there
+		os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+		io = _read_io(proc.pid)
+	_, status, rusage = os.wait4(proc.pid, 0)
+	proc.returncode = os.waitstatus_to_exitcode(status)
+
+	if io is not None:
+		read_bytes, write_bytes = io["read_bytes"], io["write_bytes"]
+	else:
+		# 512 byte blocks
+		read_bytes, write_bytes = rusage.ru_inblock * 512, rusage.ru_oublock * 512
+	return Usage(1, time.monotonic() - start, rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss * 1024, read_bytes, write_bytes)
+
+
+@contextmanager
+def stage(package: str, name: str):
+	"""Account the processes run in this context to the stage name of package."""
+	token = _stage.set((package, name))
+	try:
+		yield
+	finally:
+		_stage.reset(token)
+
+
+def _size(n: int) -> str:
+	for unit in ("B", "K", "M", "G"):
+		if n < 1024 or unit == "G":
+			return f"{n:.0f}{unit}" if unit == "B" else f"{n:.1f}{unit}"
+		n /= 1024
+
+
+class Accounting:
+	"""Usage of every process mkcross ran, by (target, package, stage)."""
+	usage: Dict[Tuple[str, str, str], Usage]
+
+	def __init__(self):
+		self.usage = {}
+		self._lock = threading.Lock()
+
+	def add(self, target: Optional[str], usage: Usage):
+		package, stage = _stage.get()
+		with self._lock:
+			self.usage.setdefault((target or "-", package, stage), Usage()).add(usage)
+
+	def report(self) -> List[str]:
+		"""Lines of a table of the usage of each stage, most CPU time first, and of each target."""
+		with self._lock:
+			rows = sorted(self.usage.items(), key=lambda item: -item[1].cpu)
+
+		targets: Dict[str, Usage] = {}
+		for (target, _, _), usage in rows:
+			targets.setdefault(target, Usage()).add(usage)
+
+		def line(name: str, usage: Usage) -> str:
+			return f"{name:<48} {usage.processes:>5} {usage.wall:>8.1f}s {usage.cpu:>8.1f}s {usage.utilisation:>5.1f} {_size(usage.maxrss):>7} {_size(usage.read_bytes):>7} {_size(usage.write_bytes):>7}"
+
+		lines = [f"{'target / package / stage':<48} {'procs':>5} {'wall':>9} {'cpu':>9} {'util':>5} {'maxrss':>7} {'read':>7} {'write':>7}"]
+		lines += [line(" / ".join(key), usage) for key, usage in rows]
+		lines += ["Per target:"] + [line(target, usage) for target, usage in targets.items()]
+		return lines
+
+
+# Every process run() starts is accounted here, set up by setup()
+active = Accounting()
+
+
+def setup() -> Accounting:
+	global active
+	active = Accounting()
+	return active
@@ -0,0 +1,71 @@
+import os
+import tarfile
+import threading
+from pathlib import Path
+from typing import Optional
+
+from mkcross.helper.output import log
+
+
+class ArtifactCache:
+	"""Installed files of built packages, as compressed tarballs keyed by their build inputs.
+
+	Hits are touched, so the least recently used ones are the first to go once
+	the cache grows too big.
+	"""
+	root: Path
+
+	def __init__(self, root: Path):
+		self.root = root
+		self._lock = threading.Lock()
+
+	def path(self, key: str) -> Path:
+		return self.root / (key + ".tar.gz")
+
+	def fetch(self, key: str) -> Optional[Path]:
+		path = self.path(key)
+		try:
+			os.utime(path)
+		except FileNotFoundError:
+			return None
+		return path
+
+	def store(self, key: str, staging: Path, max_size: int) -> Path:
+		"""Pack everything under staging as the artifact for key, then trim the cache to max_size."""
+		tmp = self.temp_path(key)
+		# Speed matters more than size here
+		with tarfile.open(tmp, "w:gz", compresslevel=3) as tar:
+			for entry in sorted(staging.iterdir()):
+				tar.add(entry, arcname=entry.name)
+		return self.add(key, tmp, max_size)
+
+	def temp_path(self, key: str) -> Path:
+		"""Somewhere to write an artifact before add(), on the same filesystem."""
+		self.root.mkdir(parents=True, exist_ok=True)
+		return self.path(key).with_name(key + f".{os.getpid()}.{threading.get_ident()}.tmp")
+
+	def add(self, key: str, tmp: Path, max_size: int) -> Path:
+		"""Move a finished artifact from tmp into place, then trim the cache to max_size."""
+		path = self.path(key)
+		os.replace(tmp, path)
+		self.evict(max_size)
+		return path
+
+	def evict(self, max_size: int):
+		with self._lock:
+			artifacts = []
+			for path in self.root.glob("*.tar.gz"):
+				try:
+					st = path.stat()
+				except FileNotFoundError:
+					continue
+				artifacts += [(st.st_mtime, st.st_size, path)]
+
+			total = sum(size for _, size, _ in artifacts)
+			# Oldest first
+			for _, size, path in sorted(artifacts):
+				if total <= max_size:
+					break
+				log("Evicting cached artifact " + path.name)
+				path.unlink(missing_ok=True)
+				total -= size
@@ -0,0 +1,113 @@
+"""Minimal artifact server for --remote-cache, eg for testing offline.
+
+python -m mkcross.helper.cache_server [--port=8080] [--root=./cache/remote]
+"""
+import hashlib
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from mkcross.helper.remote_cache import CHECKSUM_HEADER
+
+_ARTIFACT = re.compile(r"^/([0-9a-f]{64})\.tar\.gz$")
+_publish_lock = threading.Lock()
+
+
+class ArtifactHandler(BaseHTTPRequestHandler):
+	"""GET, HEAD and PUT of <key>.tar.gz under the server root, see RemoteCache."""
+	root: Path
+
+	def artifact(self):
+		m = _ARTIFACT.match(self.path)
+		if m is None:
+			self.send_error(404)
+			return None
+		return self.root / (m[1] + ".tar.gz")
+
+	def send_artifact(self, body: bool):
+		path = self.artifact()
+		if path is None:
+			return
+		try:
+			with _publish_lock:
+				digest = path.with_name(path.name + ".sha256").read_text().strip()
+				handle = open(path, "rb")
+		except FileNotFoundError:
+			self.send_error(404)
+			return
+
+		with handle:
+			self.send_response(200)
+			self.send_header("Content-Type", "application/gzip")
+			self.send_header("Content-Length", str(os.fstat(handle.fileno()).st_size))
+			self.send_header(CHECKSUM_HEADER, digest)
+			self.end_headers()
+			if body:
+				while data := handle.read(1 << 20):
+					self.wfile.write(data)
+
+	def do_GET(self):
+		self.send_artifact(body=True)
+
+	def do_HEAD(self):
+		self.send_artifact(body=False)
+
+	def do_PUT(self):
+		path = self.artifact()
+		if path is None:
+			return
+		expected = self.headers.get(CHECKSUM_HEADER, "").lower()
+		length = int(self.headers.get("Content-Length", 0))
+
+		tmp = path.with_name(path.name + f".{threading.get_ident()}.tmp")
+		digest = hashlib.sha256()
+		with open(tmp, "wb") as f:
+			while length > 0:
+				data = self.rfile.read(min(length, 1 << 20))
+				if not data:
+					break
+				digest.update(data)
+				f.write(data)
+				length -= len(data)
+
+		if length != 0 or digest.hexdigest() != expected:
+			tmp.unlink(missing_ok=True)
+			self.send_error(400, "Truncated upload or checksum mismatch")
+			return
+
+		# Builds aren't always reproducible, an artifact and its checksum have to change together
+		with _publish_lock:
+			path.with_name(path.name + ".sha256").write_text(expected + "\n")
+			os.replace(tmp, path)
+		self.send_response(201)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+
+def serve(root: Path, port: int, host: str = ""):
+	root.mkdir(parents=True, exist_ok=True)
+	handler = type("Handler", (ArtifactHandler,), {"root": root})
+	server = ThreadingHTTPServer((host, port), handler)
+	print(f"Serving artifacts in {root} on port {server.server_address[1]}")
+	server.serve_forever()
+
+
+def main():
+	root = Path("./cache/remote")
+	port = 8080
+	for arg in sys.argv[1:]:
+		argname, _, argvalue = arg.partition("=")
+		if argname == "--port":
+			port = int(argvalue)
+		elif argname == "--root":
+			root = Path(argvalue)
+		else:
+			raise ValueError(f"Unknown argument {arg}")
+	serve(root.resolve(), port)
+
+
+if __name__ == "__main__":
+	main()
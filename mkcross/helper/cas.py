@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+from mkcross.helper.output import log
+
+
+class HashingWriter:
+	"""File wrapper that hashes everything written through it, so no second read is needed."""
+
+	def __init__(self, handle, hasher=None):
+		self.handle = handle
+		self.hasher = hasher or hashlib.sha256()
+
+	def write(self, data):
+		self.hasher.update(data)
+		return self.handle.write(data)
+
+	def hexdigest(self):
+		return self.hasher.hexdigest()
+
+
+class TeeReader:
+	"""Readable stream that copies everything read from source into writer.
+
+	Meant to sit between a network response and a consumer, so the data is
+	consumed and stored in the same pass.
+	"""
+
+	def __init__(self, source, writer, size: int = None):
+		self.source = source
+		self.writer = writer
+		# Expected length, if known
+		self.size = size
+
+	def readinto(self, buf):
+		data = self.source.read(len(buf))
+		buf[:len(data)] = data
+		self.writer.write(data)
+		return len(data)
+
+	def seekable(self):
+		return False
+
+	def drain(self):
+		"""Copy whatever the consumer didn't read, eg padding after the end of an archive."""
+		while data := self.source.read(1 << 20):
+			self.writer.write(data)
+
+
+def hash_file(path: Path, hasher=None):
+	hasher = hasher or hashlib.sha256()
+	with open(path, "rb") as f:
+		while data := f.read(1 << 20):
+			hasher.update(data)
+	return hasher
+
+
+class ChecksumError(Exception):
+	pass
+
+
+class ContentStore:
+	"""Content addressed file store, keyed by SHA-256.
+
+	Objects live in root/sha256/<hex>. The index remembers which url produced
+	which object (so it doubles as a trust on first use pin) and the size and
+	mtime of each object when it was last hashed, so warm lookups only need a stat().
+	"""
+	root: Path
+	index_path: Path
+
+	def __init__(self, root: Path):
+		self.root = root
+		self.objdir = root / "sha256"
+		self.objdir.mkdir(parents=True, exist_ok=True)
+		self.index_path = root / "index.json"
+		self._lock = threading.Lock()
+		self._urls: Dict[str, str] = {}
+		self._objects: Dict[str, list] = {}
+
+		try:
+			with open(self.index_path) as f:
+				index = json.load(f)
+			self._urls = index.get("urls", {})
+			self._objects = index.get("objects", {})
+		except FileNotFoundError:
+			pass
+		except ValueError:
+			log("[W] Ignoring corrupt download index " + str(self.index_path))
+
+	def object_path(self, digest: str) -> Path:
+		return self.objdir / digest
+
+	def pinned(self, url: str) -> Optional[str]:
+		with self._lock:
+			return self._urls.get(url)
+
+	def _save(self):
+		# Called with the lock held
+		tmp = self.index_path.with_name(self.index_path.name + f".{os.getpid()}.tmp")
+		with open(tmp, "w") as f:
+			json.dump({"urls": self._urls, "objects": self._objects}, f, indent=1, sort_keys=True)
+		os.replace(tmp, self.index_path)
+
+	def verify(self, digest: str) -> bool:
+		"""Check an object is intact, rehashing only if it changed since it was indexed."""
+		path = self.object_path(digest)
+		try:
+			st = path.stat()
+		except FileNotFoundError:
+			return False
+
+		with self._lock:
+			if self._objects.get(digest) == [st.st_size, st.st_mtime_ns]:
+				return True
+
+		log("Verifying " + str(path))
+		if hash_file(path).hexdigest() != digest:
+			log("[W] " + str(path) + " is corrupt, removing it")
+			path.unlink(missing_ok=True)
+			with self._lock:
+				self._objects.pop(digest, None)
+				self._save()
+			return False
+
+		with self._lock:
+			self._objects[digest] = [st.st_size, st.st_mtime_ns]
+			self._save()
+		return True
+
+	def lookup(self, url: str) -> Optional[Path]:
+		digest = self.pinned(url)
+		if digest is None or not self.verify(digest):
+			return None
+		return self.object_path(digest)
+
+	def add(self, tmp: Path, digest: str, url: str = None, expected: str = None, pin: bool = True) -> Path:
+		"""Move a finished download into the store, failing if it doesn't match what is expected.
+
+		expected defaults to whatever url resolved to before, when pin is set.
+		"""
+		if expected is None and pin and url is not None:
+			expected = self.pinned(url)
+
+		if expected is not None and expected != digest:
+			tmp.unlink(missing_ok=True)
+			raise ChecksumError(f"{url or tmp}: expected sha256 {expected}, got {digest}")
+
+		path = self.object_path(digest)
+		os.replace(tmp, path)
+		st = path.stat()
+
+		with self._lock:
+			self._objects[digest] = [st.st_size, st.st_mtime_ns]
+			if url is not None:
+				self._urls[url] = digest
+			self._save()
+		return path
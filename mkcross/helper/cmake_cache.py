@@ -0,0 +1,72 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+from typing import Dict, Tuple
+
+# check_*_compiler_flag() results, these only depend on the compiler and flags
+_FLAG_CHECK = re.compile(r"^(?!CMAKE_).*(_FLAG|_SUPPORTS_.*)$")
+# Header, symbol and library checks, these also depend on what is in the sysroot
+_OTHER_CHECK = re.compile(r"^(HAVE_|CMAKE_HAVE_|(?!CMAKE_).*_HAS_)")
+_RESULTS = {"", "0", "1", "TRUE", "FALSE", "ON", "OFF"}
+_ENTRY = re.compile(r"^([A-Za-z0-9_+.-]+):INTERNAL=(.*)$")
+
+_lock = threading.Lock()
+
+
+def read_check_results(cmakecache: Path) -> Tuple[Dict[str, str], Dict[str, str]]:
+	"""Try-compile results in a CMakeCache.txt, as (compiler flag checks, other checks)."""
+	flags = {}
+	others = {}
+	try:
+		with open(cmakecache) as f:
+			for line in f:
+				m = _ENTRY.match(line.rstrip("\n"))
+				if m is None or m[2] not in _RESULTS:
+					continue
+				if _FLAG_CHECK.match(m[1]):
+					flags[m[1]] = m[2]
+				elif _OTHER_CHECK.match(m[1]):
+					others[m[1]] = m[2]
+	except FileNotFoundError:
+		pass
+	return flags, others
+
+
+class CheckCache:
+	"""Try-compile results shared by every configure with the same key.
+
+	The key has to cover everything the results depend on (compiler, flags,
+	target), so a changed compiler or flag simply lands in a new cache.
+	"""
+	path: Path
+
+	def __init__(self, root: Path, key: str):
+		self.path = root / (key + ".json")
+
+	def load(self) -> Dict[str, str]:
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return {}
+
+	def update(self, results: Dict[str, str]):
+		if not results:
+			return
+		with _lock:
+			merged = {**self.load(), **results}
+			self.path.parent.mkdir(parents=True, exist_ok=True)
+			tmp = self.path.with_name(self.path.name + f".{os.getpid()}.tmp")
+			with open(tmp, "w") as f:
+				json.dump(merged, f, indent=1, sort_keys=True)
+			os.replace(tmp, self.path)
+
+
+def write_initial_cache(path: Path, results: Dict[str, str]):
+	"""Write results as a script for cmake -C."""
+	with open(path, "w") as f:
+		f.write("# Generated by mkcross from earlier configures\n")
+		for name, value in sorted(results.items()):
+			f.write(f'set({name} "{value}" CACHE INTERNAL "")\n')
@@ -0,0 +1,133 @@
+import os
+import shutil
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Set, Tuple
+
+from mkcross.helper.cas import hash_file
+from mkcross.helper.output import log
+
+# Files smaller than this cost more in hashing than they save
+MIN_SIZE = 1024
+# In a sysroot with files from the store, relative to it
+DEDUP_MARKER = "etc/mkcross/deduplicated"
+
+
+class DedupStore:
+	"""Content addressed files shared between sysroots by hardlinks.
+
+	Objects live in root/<xx>/<sha256>[.x], .x for executables. They are made
+	read-only, since a write into one would change every sysroot sharing it.
+	Everything mkcross puts into a deduplicated sysroot (DEDUP_MARKER) replaces
+	files (install_tree(), the extractor) rather than writing into them;
+	builds that don't get the sysroot unshare_tree()'d first.
+	"""
+	root: Path
+
+	def __init__(self, root: Path):
+		self.root = root
+
+	def object_path(self, digest: str, executable: bool) -> Path:
+		return self.root / digest[:2] / (digest + (".x" if executable else ""))
+
+	def check_filesystem(self, path: Path):
+		"""Raise unless files under path can be linked into the store."""
+		self.root.mkdir(parents=True, exist_ok=True)
+		if os.stat(path).st_dev != os.stat(self.root).st_dev:
+			raise ValueError(f"{path} is on another filesystem than the dedup store {self.root}, "
+				"set MKCROSS_CACHE_DIR to a directory on the same one")
+
+	def objects(self) -> Iterable[Path]:
+		return self.root.glob("??/*")
+
+	def _object_inodes(self) -> Set[Tuple[int, int]]:
+		inodes = set()
+		for path in self.objects():
+			st = path.stat()
+			inodes.add((st.st_dev, st.st_ino))
+		return inodes
+
+	def add_file(self, path: Path, st: os.stat_result) -> int:
+		"""Replace path with a link to its object, returns the bytes that saved."""
+		executable = bool(st.st_mode & stat.S_IXUSR)
+		obj = self.object_path(hash_file(path).hexdigest(), executable)
+		tmp = path.with_name(path.name + f".__dedup_{threading.get_ident()}__")
+
+		try:
+			objst = obj.stat()
+		except FileNotFoundError:
+			# First of its kind, the file itself becomes the object
+			obj.parent.mkdir(parents=True, exist_ok=True)
+			objtmp = obj.with_name(obj.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+			try:
+				os.link(path, objtmp)
+			except OSError as e:
+				log(f"[W] Can't link {path} into {self.root}: {e}")
+				return 0
+			os.chmod(objtmp, stat.S_IMODE(st.st_mode) & ~0o222)
+			os.replace(objtmp, obj)
+			return 0
+
+		if objst.st_size != st.st_size:
+			log(f"[W] {obj} doesn't match its size, not deduplicating {path}")
+			return 0
+		try:
+			os.link(obj, tmp)
+		except OSError as e:
+			# Too many links, or another filesystem
+			log(f"[W] Can't link {path} to {obj}: {e}")
+			return 0
+		os.replace(tmp, path)
+		return st.st_size
+
+	def add_tree(self, tree: Path, exclude: Tuple[str, ...] = (), jobs: int = None) -> Tuple[int, int]:
+		"""Deduplicate every regular file in tree, returns (files linked, bytes saved).
+
+		exclude lists paths relative to tree that are left alone, eg files that
+		get rewritten in place.
+		"""
+		self.check_filesystem(tree)
+
+		known = self._object_inodes()
+		files = []
+		for root, dirs, names in os.walk(tree):
+			rel = Path(root).relative_to(tree)
+			dirs[:] = [d for d in dirs if str(rel / d) not in exclude]
+			for name in names:
+				path = Path(root) / name
+				st = os.lstat(path)
+				if not stat.S_ISREG(st.st_mode) or st.st_size < MIN_SIZE:
+					continue
+				if (st.st_dev, st.st_ino) in known:
+					continue
+				files += [(path, st)]
+
+		with ThreadPoolExecutor(max_workers=jobs or os.cpu_count(), thread_name_prefix="dedup") as executor:
+			saved = list(executor.map(lambda f: self.add_file(*f), files))
+		return len(files), sum(saved)
+
+	def prune(self) -> int:
+		"""Remove objects no sysroot links to any more, returns the bytes freed."""
+		freed = 0
+		for path in self.objects():
+			st = path.stat()
+			if st.st_nlink == 1:
+				path.unlink()
+				freed += st.st_size
+		return freed
+
+
+def unshare_tree(tree: Path):
+	"""Give every hardlinked file in tree its own writable copy again, for builds that write into it."""
+	for root, _, names in os.walk(tree):
+		for name in names:
+			path = Path(root) / name
+			st = os.lstat(path)
+			if not stat.S_ISREG(st.st_mode) or st.st_nlink == 1:
+				continue
+			tmp = path.with_name(path.name + ".__unshare__")
+			shutil.copy2(path, tmp)
+			os.chmod(tmp, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+			os.replace(tmp, path)
@@ -0,0 +1,318 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+from mkcross.helper.cas import HashingWriter, hash_file
+from mkcross.helper.output import log
+
+# Bytes per read and write
+CHUNK = 1 << 20
+# Below this, one connection is about as fast as several
+SEGMENT_MIN = 16 << 20
+# Bytes of a segmented download between saving how far it got
+SAVE_EVERY = 32 << 20
+# Attempts for a download that fails half way, on top of the retries of each request
+RETRIES = 5
+# (connect, read) seconds
+TIMEOUT = (10, 60)
+# Errors worth trying again after
+TRANSIENT = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def session() -> requests.Session:
+	"""The session every download shares, so connections are kept alive and reused.
+
+	Requests that fail to connect or get a 429/5xx are retried with backoff.
+	"""
+	global _session
+	with _session_lock:
+		if _session is None:
+			retry = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=True)
+			adapter = HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=retry)
+			_session = requests.Session()
+			_session.mount("http://", adapter)
+			_session.mount("https://", adapter)
+		return _session
+
+
+def local_path(url: str) -> Optional[Path]:
+	"""The file a file:// url points to, None for other urls."""
+	parsed = urlparse(url)
+	if parsed.scheme != "file":
+		return None
+	return Path(unquote(parsed.path))
+
+
+def backoff(attempt: int):
+	time.sleep(min(0.5 * 2 ** attempt, 30))
+
+
+class RangeNotSupported(Exception):
+	pass
+
+
+def _copy_local(src: Path, path: Path, bar: tqdm):
+	size = src.stat().st_size
+	bar.reset(total=size)
+	with open(src, "rb") as fsrc, open(path, "wb") as fdest:
+		writer = HashingWriter(fdest)
+		while data := fsrc.read(CHUNK):
+			writer.write(data)
+			bar.update(len(data))
+	return writer.hasher, size
+
+
+def _download_single(url: str, path: Path, bar: tqdm):
+	"""Download in one stream, resuming what is already at path. Returns the hasher and the bytes received."""
+	offset = path.stat().st_size if path.exists() else 0
+	hasher = None
+	received = 0
+
+	for attempt in range(RETRIES):
+		headers = {"Range": f"bytes={offset}-"} if offset else {}
+		try:
+			with session().get(url, headers=headers, stream=True, timeout=TIMEOUT) as r:
+				if r.status_code == 416 and offset:
+					# The file changed since, start over
+					offset = 0
+					hasher = None
+					continue
+				r.raise_for_status()
+				# A 206 is the only proof the server honoured the range
+				if offset and r.status_code != 206:
+					offset = 0
+					hasher = None
+				if hasher is None:
+					if offset:
+						log("Resuming download of " + url)
+					hasher = hash_file(path) if offset else hashlib.sha256()
+					length = int(r.headers.get("Content-Length", 0))
+					bar.reset(total=offset + length if length else None)
+					bar.update(offset)
+
+				with open(path, "ab" if offset else "wb") as f:
+					for data in r.iter_content(chunk_size=CHUNK):
+						f.write(data)
+						hasher.update(data)
+						offset += len(data)
+						received += len(data)
+						bar.update(len(data))
+			return hasher, received
+		except TRANSIENT as e:
+			if attempt == RETRIES - 1:
+				raise
+			log(f"[W] Download of {url} failed, retrying: {e}")
+			backoff(attempt)
+	# Only a 416 on the last attempt gets here
+	raise requests.HTTPError(f"Download of {url} still got 416 Range Not Satisfiable after {RETRIES} attempts")
+
+
+class _Segments:
+	"""Progress of a segmented download, kept next to it so it can resume."""
+
+	def __init__(self, path: Path, size: int, count: int):
+		self.path = path.with_name(path.name + ".segments")
+		self.size = size
+		self._lock = threading.Lock()
+		self._unsaved = 0
+
+		state = None
+		try:
+			with open(self.path) as f:
+				state = json.load(f)
+		except (FileNotFoundError, ValueError):
+			pass
+
+		if state is not None and state["size"] == size and path.exists():
+			self.done: Dict[int, int] = {int(start): done for start, done in state["done"].items()}
+			self.ends: Dict[int, int] = {int(start): end for start, end in state["ends"].items()}
+			self.resumed = True
+			return
+
+		step = -(-size // count)
+		self.ends = {start: min(start + step, size) - 1 for start in range(0, size, step)}
+		self.done = {start: 0 for start in self.ends}
+		self.resumed = False
+
+	def advance(self, start: int, n: int):
+		with self._lock:
+			self.done[start] += n
+			self._unsaved += n
+			# Only ever behind what is written, so a kill costs at most this much
+			if self._unsaved >= SAVE_EVERY:
+				self._write()
+
+	def save(self):
+		with self._lock:
+			self._write()
+
+	def _write(self):
+		tmp = self.path.with_name(self.path.name + ".tmp")
+		with open(tmp, "w") as f:
+			json.dump({"size": self.size, "ends": self.ends, "done": self.done}, f)
+		os.replace(tmp, self.path)
+		self._unsaved = 0
+
+	def clear(self):
+		self.path.unlink(missing_ok=True)
+
+
+class _PrefixHasher:
+	"""Hashes a segmented download front to back while the segments arrive.
+
+	What is written at the end of the hashed prefix goes straight into the
+	hasher. A later segment is read back only for what arrived before the
+	prefix reached it, from the page cache, and is then hashed as it streams.
+	"""
+
+	def __init__(self, fd: int, segments: _Segments):
+		self.fd = fd
+		self.segments = segments
+		self.hasher = hashlib.sha256()
+		self.hashed = 0
+		self._starts = sorted(segments.ends)
+		self._lock = threading.Lock()
+
+	def wrote(self, pos: int, data: bytes):
+		"""data was written at pos and counted in segments."""
+		with self._lock:
+			if pos == self.hashed:
+				self.hasher.update(data)
+				self.hashed += len(data)
+			self._catch_up()
+
+	def finish(self):
+		with self._lock:
+			self._catch_up()
+		if self.hashed != self.segments.size:
+			raise RuntimeError(f"Hashed {self.hashed} of {self.segments.size} bytes")
+		return self.hasher
+
+	def _catch_up(self):
+		for start in self._starts:
+			end = self.segments.ends[start]
+			if self.hashed > end:
+				continue
+			written = start + self.segments.done[start]
+			while self.hashed < written:
+				data = os.pread(self.fd, min(CHUNK, written - self.hashed), self.hashed)
+				self.hasher.update(data)
+				self.hashed += len(data)
+			if self.hashed <= end:
+				return
+
+
+def _download_segmented(url: str, path: Path, size: int, count: int, bar: tqdm):
+	"""Download with count parallel Range requests, each writing its part in place.
+
+	Returns the hasher and the bytes received.
+	"""
+	segments = _Segments(path, size, count)
+	if segments.resumed:
+		log("Resuming download of " + url)
+	resumed = sum(segments.done.values())
+	bar.update(resumed)
+
+	fd = os.open(path, os.O_RDWR | os.O_CREAT)
+	try:
+		if not segments.resumed:
+			os.ftruncate(fd, size)
+			segments.save()
+		hasher = _PrefixHasher(fd, segments)
+
+		def fetch(start: int):
+			end = segments.ends[start]
+			for attempt in range(RETRIES):
+				pos = start + segments.done[start]
+				if pos > end:
+					return
+				try:
+					with session().get(url, headers={"Range": f"bytes={pos}-{end}"}, stream=True, timeout=TIMEOUT) as r:
+						r.raise_for_status()
+						if r.status_code != 206:
+							raise RangeNotSupported(url)
+						for data in r.iter_content(chunk_size=CHUNK):
+							if len(data) > end + 1 - pos:
+								data = data[:end + 1 - pos]
+							os.pwrite(fd, data, pos)
+							segments.advance(start, len(data))
+							hasher.wrote(pos, data)
+							pos += len(data)
+							bar.update(len(data))
+					if pos <= end:
+						raise requests.ConnectionError(f"Segment ended at {pos}, expected {end + 1}")
+					return
+				except TRANSIENT as e:
+					if attempt == RETRIES - 1:
+						raise
+					log(f"[W] Segment {start}-{end} of {url} failed, retrying: {e}")
+					segments.save()
+					backoff(attempt)
+
+		with ThreadPoolExecutor(max_workers=count, thread_name_prefix="segment") as executor:
+			try:
+				# list() so the first failure is raised
+				list(executor.map(fetch, list(segments.ends)))
+			except BaseException:
+				segments.save()
+				raise
+		hasher = hasher.finish()
+	finally:
+		os.close(fd)
+
+	segments.clear()
+	return hasher, size - resumed
+
+
+def download(url: str, path: Path, desc: str, segments: int = 1) -> Tuple[str, int]:
+	"""Download url to path, resuming what an interrupted run left there.
+
+	Returns the SHA-256 and how many bytes this call received, without what it resumed from.
+
+	file:// urls are copied. Large files from servers that support ranges are fetched over several
+	connections at once.
+	"""
+	src = local_path(url)
+	if src is not None:
+		with tqdm(desc=desc, unit="B", unit_scale=True) as bar:
+			hasher, received = _copy_local(src, path, bar)
+			return hasher.hexdigest(), received
+
+	size = None
+	if segments > 1 and (not path.exists() or path.with_name(path.name + ".segments").exists()):
+		try:
+			head = session().head(url, allow_redirects=True, timeout=TIMEOUT)
+			head.raise_for_status()
+			if head.headers.get("Accept-Ranges") == "bytes" and "Content-Encoding" not in head.headers:
+				size = int(head.headers.get("Content-Length", 0)) or None
+				# Redirects (eg to a CDN) are followed once, not by every segment
+				url = head.url
+		except (requests.RequestException, ValueError):
+			size = None
+
+	with tqdm(total=size, desc=desc, unit="B", unit_scale=True) as bar:
+		if size is not None and size >= SEGMENT_MIN:
+			try:
+				hasher, received = _download_segmented(url, path, size, segments, bar)
+				return hasher.hexdigest(), received
+			except RangeNotSupported:
+				log(f"[W] {url} ignores ranges after all, downloading in one go")
+				path.unlink(missing_ok=True)
+				path.with_name(path.name + ".segments").unlink(missing_ok=True)
+				bar.reset()
+		hasher, received = _download_single(url, path, bar)
+		return hasher.hexdigest(), received
@@ -0,0 +1,158 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, List, Optional
+
+import libarchive
+from tqdm import tqdm
+
+from mkcross.helper.output import log
+
+# Bytes of archive input between progress bar updates
+PROGRESS_STEP = 4 << 20
+# Files smaller than this are written straight from the reader thread,
+# a thread hop costs more than the write
+SMALL_FILE = 4096
+
+
+def _write_file(path: Path, chunks: List[bytes], perm: int, mtime):
+	# Replace, never write into, what is there: it may be hardlinked (source views, deduplicated sysroots)
+	path.unlink(missing_ok=True)
+	with open(path, "wb") as f:
+		f.writelines(chunks)
+		os.fchmod(f.fileno(), perm)
+	if mtime is not None:
+		os.utime(path, (mtime, mtime))
+
+
+def _safe_relpath(name: str) -> PurePosixPath:
+	rel = PurePosixPath(name.lstrip("/"))
+	if ".." in rel.parts:
+		raise ValueError(f"Refusing to extract {name}, it escapes the destination")
+	return rel
+
+
+class Extractor:
+	"""Archive extraction with a shared pool of writer threads.
+
+	The reader thread only decompresses and hands file contents to the pool;
+	directory metadata and links are applied in one batch at the end. Several
+	archives can be extracted at the same time, each gets its own reader thread
+	(libarchive drops the GIL while decompressing).
+	"""
+	writers: ThreadPoolExecutor
+	readers: ThreadPoolExecutor
+
+	def __init__(self, jobs: int):
+		self.jobs = jobs
+		self.writers = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="extract-write")
+		self.readers = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="extract-read")
+		self._pending: Dict[Path, Future] = {}
+		self._lock = threading.Lock()
+
+	def extract(self, archive, dest: Path, bar: tqdm = None, include: Callable[[PurePosixPath], bool] = None):
+		"""Extract every entry of an open libarchive reader into dest.
+
+		include, if given, selects which entries (by archive path) get written.
+		"""
+		made_dirs = {dest}
+		dirs = []
+		links = []
+		writes = set()
+		max_pending = self.jobs * 32
+		reported = 0
+
+		def ensure_dir(path: Path):
+			if path not in made_dirs:
+				path.mkdir(parents=True, exist_ok=True)
+				made_dirs.add(path)
+
+		for entry in archive:
+			rel = _safe_relpath(entry.pathname)
+			if include is not None and not include(rel):
+				continue
+			path = dest / rel
+
+			if entry.isdir:
+				ensure_dir(path)
+				dirs += [(path, entry.perm, entry.mtime)]
+			elif entry.issym or entry.islnk:
+				if entry.islnk and include is not None and not include(_safe_relpath(entry.linkpath)):
+					# The data went with the target, which wasn't extracted
+					log(f"[W] Not extracting {rel}, a hardlink to {entry.linkpath} which is excluded")
+					continue
+				links += [(path, entry.linkpath, entry.islnk)]
+			elif entry.isreg:
+				ensure_dir(path.parent)
+				chunks = []
+				for block in entry.get_blocks(1 << 20):
+					chunks += [block]
+
+				if entry.size < SMALL_FILE:
+					_write_file(path, chunks, entry.perm, entry.mtime)
+				else:
+					if len(writes) >= max_pending:
+						done, writes = wait(writes, return_when=FIRST_COMPLETED)
+						for f in done:
+							f.result()
+					writes.add(self.writers.submit(_write_file, path, chunks, entry.perm, entry.mtime))
+			# Devices, fifos etc have no place in a source tree
+
+			if bar is not None and archive.bytes_read - reported >= PROGRESS_STEP:
+				bar.update(archive.bytes_read - reported)
+				reported = archive.bytes_read
+
+		for f in writes:
+			f.result()
+
+		for path, target, hard in links:
+			ensure_dir(path.parent)
+			path.unlink(missing_ok=True)
+			if hard:
+				os.link(dest / _safe_relpath(target), path)
+			else:
+				os.symlink(target, path)
+
+		# Deepest first, so setting a mtime isn't undone by creating something inside
+		for path, perm, mtime in sorted(dirs, key=lambda d: len(d[0].parts), reverse=True):
+			os.chmod(path, perm)
+			if mtime is not None:
+				os.utime(path, (mtime, mtime))
+
+		if bar is not None:
+			bar.update(archive.bytes_read - reported)
+
+	def extract_file(self, path: Path, dest: Path, name: str = None, include: Callable[[PurePosixPath], bool] = None):
+		with tqdm(total=path.stat().st_size, desc="Extract " + (name or path.name), unit="B", unit_scale=True) as bar, \
+			libarchive.file_reader(str(path)) as archive:
+			self.extract(archive, dest, bar, include)
+
+	def extract_stream(self, stream, dest: Path, name: str, size: int = None, include: Callable[[PurePosixPath], bool] = None):
+		"""Extract from a non seekable stream with readinto(), eg a download in progress."""
+		with tqdm(total=size, desc="Fetch+extract " + name, unit="B", unit_scale=True) as bar, \
+			libarchive.stream_reader(stream, block_size=1 << 20) as archive:
+			self.extract(archive, dest, bar, include)
+
+	def schedule(self, marker: Path, stamp: Optional[str], name: str, job: Callable[[], str]) -> Future:
+		"""Run the extraction job on a reader thread, unless marker says it is already done.
+
+		marker holds the stamp job returned once the extraction finished, so a
+		changed archive gets extracted again. Without a known stamp the job always runs.
+		Extractions of the same marker are shared between callers.
+		"""
+		with self._lock:
+			future = self._pending.get(marker)
+			if future is not None:
+				return future
+
+			def run():
+				if stamp is not None and marker.exists() and marker.read_text() == stamp:
+					log("Already extracted " + name)
+					return
+				marker.unlink(missing_ok=True)
+				marker.write_text(job())
+
+			future = self.readers.submit(run)
+			self._pending[marker] = future
+			return future
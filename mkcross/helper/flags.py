@@ -3,3 +3,18 @@ def map_flags(flags, sysroot):
 
 def join_map_flags(flags, sysroot, sep=' '):
 	return sep.join(map_flags(flags, sysroot))
+
+def parse_bool(value: str):
+	if value.lower() in ["1", "on", "yes", "true"]:
+		return True
+	if value.lower() in ["0", "off", "no", "false"]:
+		return False
+	raise ValueError(f"Expected a boolean, got {value}")
+
+def parse_size(value: str):
+	"""Sizes like 512M or 20G, in bytes."""
+	units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+	value = value.strip().upper().removesuffix("B")
+	if value and value[-1] in units:
+		return int(float(value[:-1]) * units[value[-1]])
+	return int(value)
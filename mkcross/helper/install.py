@@ -0,0 +1,83 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+
+from mkcross.helper.sourceview import _UNSUPPORTED, reflink
+
+
+def _up_to_date(src: os.stat_result, dest: Path, link: bool) -> bool:
+	try:
+		st = os.lstat(dest)
+	except FileNotFoundError:
+		return False
+	if (st.st_dev, st.st_ino) == (src.st_dev, src.st_ino):
+		# A link where a copy is wanted gets replaced
+		return link
+	return (st.st_size, st.st_mtime_ns) == (src.st_size, src.st_mtime_ns)
+
+
+class _Installer:
+	def __init__(self, link: bool):
+		# Dropped once they fail, so a tree doesn't keep trying what can't work
+		self.reflink = True
+		self.link = link
+
+	def install_file(self, src: Path, dest: Path):
+		tmp = dest.with_name(dest.name + ".__install__")
+		tmp.unlink(missing_ok=True)
+
+		if self.link:
+			try:
+				os.link(src, tmp)
+				os.replace(tmp, dest)
+				return
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED:
+					raise
+				self.link = False
+
+		if self.reflink:
+			try:
+				reflink(src, tmp)
+				os.replace(tmp, dest)
+				return
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED:
+					raise
+				self.reflink = False
+
+		# copy_file_range() where the kernel has it
+		shutil.copy2(src, tmp)
+		os.replace(tmp, dest)
+
+
+def install_tree(src: Path, dest: Path, jobs: int = None, link: bool = False) -> int:
+	"""Copy the tree at src over dest, like distutils' copy_tree. Returns how many files were copied.
+
+	Files are reflinked where the filesystem can, and copied on a thread pool
+	otherwise. Files with the same size and mtime in dest are left alone. With
+	link, files are hardlinked instead; only for content neither side will
+	ever modify in place.
+	"""
+	files: List[Tuple[Path, Path]] = []
+	for root, dirs, names in os.walk(src):
+		rel = Path(root).relative_to(src)
+		(dest / rel).mkdir(parents=True, exist_ok=True)
+		for name in dirs + names:
+			s = Path(root) / name
+			d = dest / rel / name
+			if s.is_symlink():
+				target = os.readlink(s)
+				if not (d.is_symlink() and os.readlink(d) == target):
+					d.unlink(missing_ok=True)
+					os.symlink(target, d)
+			elif name in names and not _up_to_date(os.stat(s), d, link):
+				files += [(s, d)]
+
+	installer = _Installer(link)
+	with ThreadPoolExecutor(max_workers=jobs or os.cpu_count(), thread_name_prefix="install") as executor:
+		# list() so the first failure is raised
+		list(executor.map(lambda pair: installer.install_file(*pair), files))
+	return len(files)
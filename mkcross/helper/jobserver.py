@@ -0,0 +1,169 @@
+import atexit
+import functools
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+
+class Jobserver:
+	"""A GNU make jobserver, either our own FIFO or the one make gave us.
+
+	Every subprocess holds a job slot while it runs: the first one gets the
+	implicit slot of mkcross itself, the others read a token from the jobserver.
+	Their own children (make, ninja >= 1.13) then take further tokens from it,
+	so the whole tree of build jobs stays within one budget. Tools that can't
+	take tokens themselves hold several slots instead, see slot().
+	"""
+	auth: str
+	pass_fds: tuple
+
+	def __init__(self, auth: str, readfd: int, writefd: int, pass_fds=(), jobs: int = None):
+		self.auth = auth
+		self.readfd = readfd
+		self.writefd = writefd
+		self.pass_fds = pass_fds
+		self.jobs = jobs
+		self._implicit = threading.Lock()
+		# A description of the pipe of our own, so it can be non-blocking without affecting the children
+		try:
+			self._freefd = os.open(f"/proc/self/fd/{readfd}", os.O_RDONLY | os.O_NONBLOCK)
+		except OSError:
+			self._freefd = None
+
+	@classmethod
+	def create(cls, jobs: int, fifo: bool = True):
+		if not fifo:
+			# For make < 4.4, the pipe has to be inherited by every child
+			readfd, writefd = os.pipe()
+			os.write(writefd, b"+" * (jobs - 1))
+			return cls(f"{readfd},{writefd}", readfd, writefd, pass_fds=(readfd, writefd), jobs=jobs)
+
+		tmpdir = tempfile.mkdtemp(prefix="mkcross-jobserver-")
+		atexit.register(shutil.rmtree, tmpdir, ignore_errors=True)
+		path = os.path.join(tmpdir, "fifo")
+		os.mkfifo(path, 0o600)
+		# Opening read-write keeps the FIFO open without waiting for the other end
+		readfd = os.open(path, os.O_RDWR)
+		writefd = os.open(path, os.O_WRONLY)
+		os.write(writefd, b"+" * (jobs - 1))
+		return cls("fifo:" + path, readfd, writefd, jobs=jobs)
+
+	@classmethod
+	def from_makeflags(cls, makeflags: str) -> Optional["Jobserver"]:
+		"""The jobserver of the make running us, if any."""
+		# Only the last one counts, make appends
+		auths = re.findall(r"--jobserver-(?:auth|fds)=(\S+)", makeflags)
+		if not auths:
+			return None
+		auth = auths[-1]
+
+		if auth.startswith("fifo:"):
+			path = auth[len("fifo:"):]
+			try:
+				readfd = os.open(path, os.O_RDWR)
+				writefd = os.open(path, os.O_WRONLY)
+			except OSError:
+				return None
+			return cls(auth, readfd, writefd)
+
+		try:
+			readfd, writefd = (int(fd) for fd in auth.split(","))
+			os.fstat(readfd)
+			os.fstat(writefd)
+		except (ValueError, OSError):
+			# make didn't let us inherit the pipe (no + on the recipe)
+			return None
+		return cls(auth, readfd, writefd, pass_fds=(readfd, writefd))
+
+	def makeflags(self) -> str:
+		flags = f" --jobserver-auth={self.auth}"
+		if self.jobs is not None:
+			flags = f" -j{self.jobs}" + flags
+		return flags
+
+	def env(self, env: dict = None) -> dict:
+		env = dict(os.environ if env is None else env)
+		env["MAKEFLAGS"] = self.makeflags()
+		return env
+
+	def _take(self) -> Optional[bytes]:
+		if self._implicit.acquire(blocking=False):
+			return None
+		return os.read(self.readfd, 1)
+
+	def _take_free(self, n: int) -> bytes:
+		"""Up to n tokens, only those that are free right now."""
+		if n <= 0 or self._freefd is None:
+			return b""
+		try:
+			return os.read(self._freefd, n)
+		except BlockingIOError:
+			return b""
+
+	def _give(self, token: Optional[bytes]):
+		if token is None:
+			self._implicit.release()
+		else:
+			os.write(self.writefd, token)
+
+	@contextmanager
+	def slot(self, upto: int = 1):
+		"""Hold a slot, and up to upto - 1 more if they are free. Yields how many are held."""
+		token = self._take()
+		extra = self._take_free(upto - 1)
+		try:
+			yield 1 + len(extra)
+		finally:
+			if extra:
+				os.write(self.writefd, extra)
+			self._give(token)
+
+
+def make_supports_fifo(make: str = "make") -> bool:
+	"""FIFO jobservers are new in GNU make 4.4, older ones abort on them."""
+	try:
+		out = subprocess.run([make, "--version"], capture_output=True, text=True).stdout
+	except OSError:
+		return False
+	m = re.match(r"GNU Make (\d+)\.(\d+)", out)
+	return m is not None and (int(m[1]), int(m[2])) >= (4, 4)
+
+
+@functools.lru_cache(maxsize=None)
+def ninja_supports_jobserver(ninja: str = "ninja") -> bool:
+	"""ninja takes part in the jobserver since 1.13, older ones ignore MAKEFLAGS."""
+	try:
+		out = subprocess.run([ninja, "--version"], capture_output=True, text=True).stdout
+	except OSError:
+		return False
+	m = re.match(r"(\d+)\.(\d+)", out)
+	return m is not None and (int(m[1]), int(m[2])) >= (1, 13)
+
+
+def ninja_jobs() -> Optional[int]:
+	"""The most jobs to give ninja with -j, None if it gets them from the jobserver."""
+	if ninja_supports_jobserver():
+		return None
+	if active is not None and active.jobs is not None:
+		return active.jobs
+	# ninja's own default
+	return multiprocessing.cpu_count() + 2
+
+
+# The jobserver every build subprocess uses, set up by setup()
+active: Jobserver = None
+
+
+def setup(jobs: int) -> Jobserver:
+	"""Use the jobserver we inherited, or create one with jobs slots."""
+	global active
+	active = Jobserver.from_makeflags(os.environ.get("MAKEFLAGS", ""))
+	if active is None:
+		active = Jobserver.create(jobs, fifo=make_supports_fifo())
+	return active
@@ -1,20 +1,129 @@
+import json
+import os
 import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
 
 import requests
 
+from mkcross.helper import trace
+from mkcross.helper.output import log
+
+
+class VersionResolver:
+	"""Latest versions, each looked up once per run however many targets ask.
+
+	Answers come from the lockfile if it has them, then from the disk cache
+	if they are younger than ttl seconds, and only then from upstream.
+	"""
+	cache_path: Optional[Path]
+	ttl: float
+	locked: Dict[str, str]
+	# Everything resolved in this run, by key
+	resolved: Dict[str, str]
+
+	def __init__(self, cache_path: Path = None, ttl: float = 0, locked: Dict[str, str] = None):
+		self.cache_path = cache_path
+		self.ttl = ttl
+		self.locked = locked or {}
+		self.resolved = {}
+		self._locks: Dict[str, threading.Lock] = {}
+		self._lock = threading.Lock()
+
+	def _load_cache(self) -> dict:
+		try:
+			with open(self.cache_path) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return {}
+
+	def _save(self, key: str, version: str):
+		with self._lock:
+			cache = self._load_cache()
+			cache[key] = [version, time.time()]
+			tmp = self.cache_path.with_name(self.cache_path.name + f".{os.getpid()}.tmp")
+			with open(tmp, "w") as f:
+				json.dump(cache, f, indent=1, sort_keys=True)
+			os.replace(tmp, self.cache_path)
+
+	def resolve(self, key: str, lookup: Callable[[], str]) -> str:
+		with self._lock:
+			key_lock = self._locks.setdefault(key, threading.Lock())
+
+		# Other targets asking for the same key wait for the first one
+		with key_lock:
+			if key in self.resolved:
+				return self.resolved[key]
+
+			version = self.locked.get(key)
+			if version is None and self.cache_path is not None:
+				cached = self._load_cache().get(key)
+				if cached is not None and time.time() - cached[1] < self.ttl:
+					version = cached[0]
+			if version is None:
+				log("Getting latest version of " + key)
+				with trace.span("version " + key, "version"):
+					version = lookup()
+				if self.cache_path is not None:
+					self._save(key, version)
+
+			self.resolved[key] = version
+			return version
+
+
+# Used by the lookups below, set up by setup()
+active = VersionResolver()
+
+
+def setup(cache_path: Path, ttl: float, lockfile: Path = None) -> VersionResolver:
+	global active
+	locked = {}
+	if lockfile is not None and lockfile.exists():
+		with open(lockfile) as f:
+			locked = json.load(f)
+	active = VersionResolver(cache_path, ttl, locked)
+	return active
+
+
+def write_lockfile(path: Path):
+	"""Pin everything this run resolved (and was already pinned), for later runs."""
+	versions = {**active.locked, **active.resolved}
+	tmp = path.with_name(path.name + ".tmp")
+	with open(tmp, "w") as f:
+		json.dump(versions, f, indent=1, sort_keys=True)
+		f.write("\n")
+	os.replace(tmp, path)
+
 
 def github(repo):
-	headers = {'Accept': 'application/json'}
-	r = requests.get(f"https://api.github.com/repos/{repo}/releases/latest", headers=headers)
-	return r.json()["tag_name"]
+	def lookup():
+		headers = {'Accept': 'application/json'}
+		# Unauthenticated requests get 60 an hour
+		token = os.environ.get("GITHUB_TOKEN")
+		if token:
+			headers["Authorization"] = "Bearer " + token
+		r = requests.get(f"https://api.github.com/repos/{repo}/releases/latest", headers=headers)
+		r.raise_for_status()
+		return r.json()["tag_name"]
+	return active.resolve("github:" + repo, lookup)
 
 
 def git(url):
-	print("Getting latest version of " + url)
+	def lookup():
+		subproc = subprocess.run(['git', '-c', 'versionsort.suffix=-', 'ls-remote', '--tags', '--sort=v:refname', url], text=True, stdout=subprocess.PIPE, check=True)
+		return subproc.stdout.splitlines()[-1].split()[1][10:]
+	return active.resolve("git:" + url, lookup)
+
 
-	subproc = subprocess.run(['git', '-c', 'versionsort.suffix=-', 'ls-remote', '--tags', '--sort=v:refname', url], text=True, stdout=subprocess.PIPE)
+def linux():
+	def lookup():
+		r = requests.get("https://www.kernel.org/releases.json")
+		r.raise_for_status()
+		return r.json()["latest_stable"]["version"]
+	return active.resolve("kernel.org", lookup)
 
-	return subproc.stdout.splitlines()[-1].split()[1][10:]
 
 def llvm():
 	return github("llvm/llvm-project")[8:]
@@ -0,0 +1,73 @@
+import os
+import shutil
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+class CompilerLauncher:
+	"""A compiler cache (ccache, sccache) that every build system runs clang through.
+
+	ccache gets CCACHE_BASEDIR, so the absolute paths mkcross puts in flags
+	(--sysroot, -resource-dir, sources) are hashed relative to the build and
+	hits carry over to other output directories. sccache has nothing like it,
+	its hits only carry over to the same paths. Only ccache can log what each
+	compile did, so only it gets per package statistics.
+	"""
+	path: str
+	basedir: Path
+
+	def __init__(self, program: str, basedir: Path):
+		path = shutil.which(program)
+		if path is None:
+			raise ValueError(f"Compiler launcher {program} not found")
+		self.path = path
+		self.basedir = basedir
+
+	@property
+	def is_ccache(self) -> bool:
+		return "ccache" in os.path.basename(self.path)
+
+	def wrap(self, compiler: str) -> List[str]:
+		return [self.path, compiler]
+
+	def env(self, statslog: Path = None) -> dict:
+		"""Environment of every build subprocess, statslog collects what each compile did."""
+		if not self.is_ccache:
+			return {}
+		env = {
+			"CCACHE_BASEDIR": str(self.basedir),
+			# The build directory only shows up in debug info, which gets rewritten by the base dir anyway
+			"CCACHE_NOHASHDIR": "1",
+		}
+		if statslog is not None:
+			env["CCACHE_STATSLOG"] = str(statslog)
+		return env
+
+	def stats(self, statslog: Path) -> Optional[Tuple[int, int]]:
+		"""(hits, misses) logged to statslog, None if unknown."""
+		if not self.is_ccache:
+			return None
+		hits = misses = 0
+		try:
+			with open(statslog) as f:
+				for line in f:
+					line = line.strip()
+					if line.startswith("#"):
+						continue
+					if line.endswith("_hit"):
+						hits += 1
+					elif line == "cache_miss":
+						misses += 1
+		except FileNotFoundError:
+			pass
+		return hits, misses
+
+
+# The launcher builds use, if any, set up by setup()
+active: Optional[CompilerLauncher] = None
+
+
+def setup(program: str, basedir: Path) -> CompilerLauncher:
+	global active
+	active = CompilerLauncher(program, basedir)
+	return active
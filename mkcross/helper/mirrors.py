@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+from mkcross.helper.download import local_path, session
+
+# Seconds a mirror gets to answer the probe
+PROBE_TIMEOUT = 2
+# Typical download, for weighing latency against throughput
+TYPICAL_SIZE = 64 << 20
+# Assumed for hosts nothing was downloaded from yet, bytes per second
+DEFAULT_THROUGHPUT = 10 << 20
+
+
+def as_url(mirror: str) -> str:
+	"""Mirrors can be given as plain directories."""
+	if "://" in mirror:
+		return mirror
+	return Path(mirror).resolve().as_uri() + "/"
+
+
+class Mirrors:
+	"""Other places to get the files of upstream urls from.
+
+	Each mirror is an (upstream prefix, mirror prefix) pair: urls starting with
+	the upstream prefix can also be had with it replaced. The upstream prefix *
+	matches everything, by file name, for flat mirrors of the download directory.
+	Mirror prefixes are http(s) or file:// urls, or plain directories.
+
+	Local files come first. The remote mirrors and upstream follow, fastest
+	first: probe latency plus a typical download at the throughput remembered
+	for each host.
+	"""
+	mirrors: List[Tuple[str, str]]
+	stats_path: Optional[Path]
+
+	def __init__(self, mirrors: List[Tuple[str, str]] = (), stats_path: Path = None):
+		self.mirrors = [(upstream, as_url(mirror)) for upstream, mirror in mirrors]
+		self.stats_path = stats_path
+		self._latency: Dict[str, float] = {}
+		self._lock = threading.Lock()
+
+	def _throughputs(self) -> Dict[str, float]:
+		if self.stats_path is None:
+			return {}
+		try:
+			with open(self.stats_path) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return {}
+
+	def record(self, url: str, size: int, seconds: float):
+		"""Remember how fast a download from url was, for ranking its host in later runs."""
+		host = urlparse(url).netloc
+		if self.stats_path is None or not host or size < (1 << 20) or seconds <= 0:
+			return
+		with self._lock:
+			stats = self._throughputs()
+			old = stats.get(host)
+			# Smoothed, one slow download shouldn't bury a mirror
+			stats[host] = size / seconds if old is None else (old + size / seconds) / 2
+			tmp = self.stats_path.with_name(self.stats_path.name + f".{os.getpid()}.tmp")
+			with open(tmp, "w") as f:
+				json.dump(stats, f, indent=1, sort_keys=True)
+			os.replace(tmp, self.stats_path)
+
+	def _probe(self, url: str) -> float:
+		host = urlparse(url).netloc
+		with self._lock:
+			if host in self._latency:
+				return self._latency[host]
+		start = time.monotonic()
+		try:
+			session().head(url, allow_redirects=True, timeout=PROBE_TIMEOUT).raise_for_status()
+			latency = time.monotonic() - start
+		except requests.RequestException:
+			latency = float("inf")
+		with self._lock:
+			# Per host, the other files there answer the same
+			self._latency.setdefault(host, latency)
+		return latency
+
+	def candidates(self, url: str, filename: str) -> List[str]:
+		"""Urls to try for url, best first. url itself is always one of them."""
+		local = []
+		remote = []
+		for upstream, mirror in self.mirrors:
+			if upstream == "*":
+				candidate = mirror + filename
+			elif url.startswith(upstream):
+				candidate = mirror + url[len(upstream):]
+			else:
+				continue
+
+			path = local_path(candidate)
+			if path is None:
+				remote += [candidate]
+			elif path.is_file():
+				local += [candidate]
+		remote += [url]
+
+		if len(remote) > 1:
+			with ThreadPoolExecutor(max_workers=len(remote), thread_name_prefix="probe") as executor:
+				latencies = list(executor.map(self._probe, remote))
+			throughputs = self._throughputs()
+
+			def estimate(i: int) -> float:
+				throughput = throughputs.get(urlparse(remote[i]).netloc, DEFAULT_THROUGHPUT)
+				return latencies[i] + TYPICAL_SIZE / throughput
+
+			# Unreachable ones stay, in their configured order, in case the probe lied
+			remote = [remote[i] for i in sorted(range(len(remote)), key=estimate)]
+
+		return local + remote
+
+
+# The mirrors every download uses, set up by setup()
+active = Mirrors()
+
+
+def setup(mirrors: List[Tuple[str, str]], stats_path: Path) -> Mirrors:
+	global active
+	active = Mirrors(mirrors, stats_path)
+	return active
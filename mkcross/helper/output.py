@@ -0,0 +1,112 @@
+import os
+import shlex
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+
+from mkcross.helper import accounting, jobserver
+
+# Which target is being worked on, set by target_output(). Threads working
+# for a target need to run in a copy of its context (contextvars.copy_context()).
+_prefix: ContextVar[str] = ContextVar("prefix", default=None)
+_logfile: ContextVar = ContextVar("logfile", default=None)
+# Added to the environment of every subprocess in this context, see extra_env()
+_env: ContextVar[dict] = ContextVar("env", default={})
+_print_lock = threading.Lock()
+
+
+@contextmanager
+def target_output(name: str, logfile: Path = None):
+	"""Tag everything logged in this context with name.
+
+	With a logfile, output of subprocesses goes there instead of the terminal,
+	so targets built at the same time don't interleave.
+	"""
+	handle = open(logfile, "w") if logfile is not None else None
+	prefix_token = _prefix.set(name)
+	logfile_token = _logfile.set(handle)
+	try:
+		yield
+	finally:
+		_prefix.reset(prefix_token)
+		_logfile.reset(logfile_token)
+		if handle is not None:
+			handle.close()
+
+
+def current_target() -> Optional[str]:
+	"""The name given to target_output() in this context, if any."""
+	return _prefix.get()
+
+
+@contextmanager
+def extra_env(env: dict):
+	"""Add env to the environment of everything run() starts in this context."""
+	token = _env.set({**_env.get(), **env})
+	try:
+		yield
+	finally:
+		_env.reset(token)
+
+
+def log(*args):
+	prefix = _prefix.get()
+	logfile = _logfile.get()
+	if logfile is not None:
+		print(*args, file=logfile, flush=True)
+	with _print_lock:
+		if prefix is not None:
+			print(f"[{prefix}]", *args, flush=True)
+		else:
+			print(*args, flush=True)
+
+
+def _run(cmd, check: bool, **kwargs) -> subprocess.CompletedProcess:
+	start = time.monotonic()
+	with subprocess.Popen(cmd, **kwargs) as proc:
+		try:
+			used = accounting.wait(proc, start)
+		except BaseException:
+			proc.kill()
+			proc.wait()
+			raise
+	accounting.active.add(_prefix.get(), used)
+
+	if check and proc.returncode:
+		raise subprocess.CalledProcessError(proc.returncode, proc.args)
+	return subprocess.CompletedProcess(proc.args, proc.returncode)
+
+
+def run(cmd, check=True, jobs: int = None, **kwargs):
+	"""subprocess.run(), logged and redirected to the target's log when there is one.
+
+	What the process used is accounted in accounting.active. jobs is for tools
+	that can't take jobserver tokens themselves (ninja < 1.13): they hold up to
+	that many slots and get -j with how many that was.
+	"""
+	logfile = _logfile.get()
+	if logfile is not None:
+		kwargs.setdefault("stdout", logfile)
+		kwargs.setdefault("stderr", subprocess.STDOUT)
+
+	if _env.get():
+		kwargs["env"] = {**kwargs.get("env", os.environ), **_env.get()}
+
+	js = jobserver.active
+	if js is None:
+		if jobs is not None:
+			cmd = [*cmd, f"-j{jobs}"]
+		log("[I] Running", shlex.join(str(arg) for arg in cmd))
+		return _run(cmd, check, **kwargs)
+
+	kwargs["env"] = js.env(kwargs.get("env"))
+	kwargs["pass_fds"] = tuple(kwargs.get("pass_fds", ())) + js.pass_fds
+	with js.slot(jobs or 1) as held:
+		if jobs is not None:
+			cmd = [*cmd, f"-j{held}"]
+		log("[I] Running", shlex.join(str(arg) for arg in cmd))
+		return _run(cmd, check, **kwargs)
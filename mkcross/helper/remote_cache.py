@@ -0,0 +1,130 @@
+import contextvars
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+import requests
+
+from mkcross.helper.artifacts import ArtifactCache
+from mkcross.helper.cas import ChecksumError, HashingWriter
+from mkcross.helper.output import log
+
+# Sent with every artifact both ways, see mkcross.helper.cache_server
+CHECKSUM_HEADER = "X-Checksum-Sha256"
+# (connect, read) seconds, a dead cache shouldn't hold up the build
+TIMEOUT = (5, 60)
+
+
+class RemoteCache:
+	"""Artifacts shared between machines over plain HTTP.
+
+	GET <url>/<key>.tar.gz fetches an artifact, 404 if there is none, and PUT
+	uploads one. Both carry the SHA-256 of the artifact in CHECKSUM_HEADER.
+	Pulled artifacts land in the local ArtifactCache. Once the server can't be
+	reached, the rest of the run builds locally without asking it again.
+	"""
+	url: str
+	push_enabled: bool
+
+	def __init__(self, url: str, jobs: int, push: bool = True):
+		self.url = url.rstrip("/")
+		self.push_enabled = push
+		self.executor = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="remote-cache")
+		# Pulls running or finished in this process, by key
+		self._pulls: Dict[str, Future] = {}
+		self._lock = threading.Lock()
+		self._offline = False
+
+	def artifact_url(self, key: str) -> str:
+		return f"{self.url}/{key}.tar.gz"
+
+	def _unreachable(self, e: Exception):
+		if not self._offline:
+			self._offline = True
+			log(f"[W] Remote cache {self.url} is unreachable, building locally: {e}")
+
+	def schedule_pull(self, key: str, cache: ArtifactCache, max_size: int) -> Future:
+		"""Start pulling key into cache, unless that already happened. The future gives its path or None."""
+		with self._lock:
+			future = self._pulls.get(key)
+			if future is None:
+				# Keep the caller's log context in the worker
+				future = self.executor.submit(contextvars.copy_context().run, self._pull, key, cache, max_size)
+				self._pulls[key] = future
+			return future
+
+	def pull(self, key: str, cache: ArtifactCache, max_size: int) -> Optional[Path]:
+		return self.schedule_pull(key, cache, max_size).result()
+
+	def _pull(self, key: str, cache: ArtifactCache, max_size: int) -> Optional[Path]:
+		if self._offline:
+			return None
+
+		tmp = cache.temp_path(key)
+		try:
+			r = requests.get(self.artifact_url(key), stream=True, timeout=TIMEOUT)
+			if r.status_code == 404:
+				return None
+			r.raise_for_status()
+
+			with open(tmp, "wb") as handle:
+				writer = HashingWriter(handle)
+				for data in r.iter_content(chunk_size=1 << 20):
+					writer.write(data)
+
+			expected = r.headers.get(CHECKSUM_HEADER, "").lower()
+			if writer.hexdigest() != expected:
+				raise ChecksumError(f"{self.artifact_url(key)}: got sha256 {writer.hexdigest()}, expected {expected or 'nothing'}")
+		except (requests.ConnectionError, requests.Timeout) as e:
+			tmp.unlink(missing_ok=True)
+			self._unreachable(e)
+			return None
+		except (requests.RequestException, ChecksumError) as e:
+			tmp.unlink(missing_ok=True)
+			log(f"[W] Not using remote artifact {key[:16]}: {e}")
+			return None
+
+		log(f"Pulled artifact {key[:16]} from {self.url}")
+		return cache.add(key, tmp, max_size)
+
+	def push(self, key: str, path: Path):
+		"""Upload the artifact at path in the background."""
+		if not self.push_enabled or self._offline:
+			return
+		# Opened now, eviction may remove path before the upload starts
+		handle = open(path, "rb")
+		self.executor.submit(contextvars.copy_context().run, self._push, key, handle)
+
+	def _push(self, key: str, handle):
+		with handle:
+			digest = hashlib.sha256()
+			while data := handle.read(1 << 20):
+				digest.update(data)
+			handle.seek(0)
+
+			try:
+				r = requests.put(self.artifact_url(key), data=handle, headers={CHECKSUM_HEADER: digest.hexdigest()}, timeout=TIMEOUT)
+				r.raise_for_status()
+			except (requests.ConnectionError, requests.Timeout) as e:
+				self._unreachable(e)
+				return
+			except requests.RequestException as e:
+				log(f"[W] Couldn't push artifact {key[:16]}: {e}")
+				return
+		log(f"Pushed artifact {key[:16]} to {self.url}")
+
+	def shutdown(self):
+		"""Wait for uploads to finish."""
+		self.executor.shutdown(wait=True)
+
+
+# The remote cache, if one is configured, set up by setup()
+active: Optional[RemoteCache] = None
+
+
+def setup(url: str, jobs: int, push: bool = True) -> RemoteCache:
+	global active
+	active = RemoteCache(url, jobs, push)
+	return active
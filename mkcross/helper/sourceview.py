@@ -0,0 +1,128 @@
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import threading
+from pathlib import Path
+from typing import Callable, List
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+# What link() and FICLONE fail with when the filesystem can't do them
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EPERM, errno.EMLINK}
+
+
+def reflink(src: Path, dest: Path):
+	"""Copy src to dest sharing its extents, OSError if the filesystem can't."""
+	try:
+		with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+			fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+	except OSError:
+		dest.unlink(missing_ok=True)
+		raise
+	shutil.copystat(src, dest)
+
+
+def hardlink(src: Path, dest: Path):
+	os.link(src, dest)
+
+
+def symlink(src: Path, dest: Path):
+	os.symlink(src, dest)
+
+
+# Cheapest first, each is only tried if the ones before aren't supported
+CLONE_METHODS: List[Callable[[Path, Path], None]] = [reflink, hardlink, symlink]
+
+
+class SourceView:
+	"""A writable view of a source tree, for builds that write next to their sources.
+
+	Files are reflinked where the filesystem supports it (btrfs, xfs, ...),
+	which takes no space until the build writes to them. Otherwise they are
+	hardlinked, or symlinked across filesystems, and the shared files made
+	read-only: builds that create or replace files stay private, one that
+	writes into a file in place fails instead of changing every target's sources.
+
+	sync() is incremental: only files that changed in the source since the
+	last one are cloned again, and whatever the build added is left alone.
+	"""
+	source: Path
+	path: Path
+
+	def __init__(self, source: Path, path: Path):
+		self.source = source
+		self.path = path
+		self._methods = list(CLONE_METHODS)
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _current(src: Path, dest: Path) -> bool:
+		try:
+			st = os.lstat(dest)
+		except FileNotFoundError:
+			return False
+		if os.path.islink(dest):
+			return os.readlink(dest) == str(src)
+		srcst = os.stat(src)
+		if (st.st_dev, st.st_ino) == (srcst.st_dev, srcst.st_ino):
+			return True
+		# A reflink keeps size and mtime until either side changes
+		return (st.st_size, st.st_mtime_ns) == (srcst.st_size, srcst.st_mtime_ns)
+
+	def _clone(self, src: Path, dest: Path):
+		tmp = dest.with_name(dest.name + ".__clone__")
+		tmp.unlink(missing_ok=True)
+		while True:
+			method = self._methods[0]
+			try:
+				method(src, tmp)
+				break
+			except OSError as e:
+				if e.errno not in _UNSUPPORTED or len(self._methods) == 1:
+					raise
+				self._methods.pop(0)
+		if method is not reflink:
+			mode = stat.S_IMODE(os.stat(src).st_mode)
+			if mode & 0o222:
+				os.chmod(src, mode & ~0o222)
+		os.replace(tmp, dest)
+
+	@staticmethod
+	def _replace_with_link(target: str, dest: Path):
+		if os.path.islink(dest) and os.readlink(dest) == target:
+			return
+		if dest.is_dir() and not dest.is_symlink():
+			shutil.rmtree(dest)
+		else:
+			dest.unlink(missing_ok=True)
+		os.symlink(target, dest)
+
+	def sync(self):
+		"""Bring the view up to date with the source."""
+		with self._lock:
+			source = self.source.resolve()
+			self.path.mkdir(parents=True, exist_ok=True)
+
+			for root, dirs, files in os.walk(source):
+				rel = Path(root).relative_to(source)
+				for d in dirs:
+					src = Path(root) / d
+					dest = self.path / rel / d
+					if src.is_symlink():
+						# Not walked into, a link is all it needs
+						self._replace_with_link(os.readlink(src), dest)
+						continue
+					if dest.is_symlink() or dest.is_file():
+						dest.unlink()
+					dest.mkdir(exist_ok=True)
+
+				for f in files:
+					src = Path(root) / f
+					dest = self.path / rel / f
+					if src.is_symlink():
+						self._replace_with_link(os.readlink(src), dest)
+					elif not self._current(src, dest):
+						self._clone(src, dest)
@@ -0,0 +1,59 @@
+import json
+import os
+from pathlib import Path
+from typing import List
+
+from mkcross.helper.toolchain import inputs_hash
+
+
+def _differences(old, new, prefix=""):
+	if isinstance(old, dict) and isinstance(new, dict):
+		diffs = []
+		for key in sorted(set(old) | set(new)):
+			diffs += _differences(old.get(key), new.get(key), f"{prefix}{key}.")
+		return diffs
+	return [] if old == new else [prefix[:-1]]
+
+
+class Stamp:
+	"""Record of the inputs a stage last completed with.
+
+	The stage only needs to run again when its inputs differ. Its digest is
+	what later stages record as their input, so changes ripple down.
+	"""
+	path: Path
+	inputs: dict
+
+	def __init__(self, path: Path, inputs: dict):
+		self.path = path
+		self.inputs = inputs
+
+	@property
+	def digest(self) -> str:
+		return inputs_hash(self.inputs)
+
+	def recorded(self):
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except (FileNotFoundError, ValueError):
+			return None
+
+	def changes(self) -> List[str]:
+		"""Why the stage has to run, nothing if it is up to date."""
+		old = self.recorded()
+		if old is None:
+			return ["it never completed"]
+		# Round trip, so tuples and lists compare equal
+		new = json.loads(json.dumps(self.inputs, default=str))
+		return [f"{name} changed" for name in _differences(old, new)]
+
+	def write(self):
+		self.path.parent.mkdir(parents=True, exist_ok=True)
+		tmp = self.path.with_name(self.path.name + ".tmp")
+		with open(tmp, "w") as f:
+			json.dump(self.inputs, f, indent=1, sort_keys=True, default=str)
+		os.replace(tmp, self.path)
+
+	def clear(self):
+		self.path.unlink(missing_ok=True)
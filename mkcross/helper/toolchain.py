@@ -0,0 +1,18 @@
+import functools
+import hashlib
+import json
+import shutil
+import subprocess
+
+
+@functools.lru_cache(maxsize=None)
+def clang_version(clang: str = "clang") -> str:
+	"""Identifies the host clang, for keying anything it produced."""
+	path = shutil.which(clang)
+	out = subprocess.run([path, "--version"], capture_output=True, check=True, text=True).stdout
+	return path + "\n" + out
+
+
+def inputs_hash(*inputs) -> str:
+	"""Stable hash of anything json can represent."""
+	return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
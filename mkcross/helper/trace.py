@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from mkcross.helper.output import current_target
+
+# Longest spans listed in the summary
+SUMMARY_SPANS = 10
+
+
+class Tracer:
+	"""Timing spans of a run, written as a Chrome trace (chrome://tracing, ui.perfetto.dev).
+
+	Each target is a process in the trace and each thread a track in it, so
+	stages running at the same time show up side by side. Work shared between
+	targets (downloads, extraction) goes in a process of its own.
+	"""
+	# Complete ("X") events, times in microseconds since start
+	events: List[dict]
+
+	def __init__(self):
+		self.start = time.perf_counter()
+		self.events = []
+		self._pids: Dict[str, int] = {}
+		self._threads = set()
+		self._lock = threading.Lock()
+
+	def _now(self) -> int:
+		return int((time.perf_counter() - self.start) * 1e6)
+
+	def _track(self) -> Tuple[int, int]:
+		"""(pid, tid) for the calling thread, naming them in the trace the first time."""
+		process = current_target() or "mkcross"
+		thread = threading.current_thread()
+		with self._lock:
+			pid = self._pids.get(process)
+			if pid is None:
+				pid = self._pids[process] = len(self._pids) + 1
+				self.events += [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": process}}]
+			if (pid, thread.ident) not in self._threads:
+				self._threads.add((pid, thread.ident))
+				self.events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread.ident, "args": {"name": thread.name}}]
+		return pid, thread.ident
+
+	@contextmanager
+	def span(self, name: str, cat: str, **args):
+		pid, tid = self._track()
+		start = self._now()
+		try:
+			yield
+		finally:
+			event = {"name": name, "cat": cat, "ph": "X", "ts": start, "dur": self._now() - start, "pid": pid, "tid": tid}
+			if args:
+				event["args"] = args
+			with self._lock:
+				self.events += [event]
+
+	def write(self, path: Path):
+		tmp = path.with_name(path.name + ".tmp")
+		with self._lock, open(tmp, "w") as f:
+			json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+		os.replace(tmp, path)
+
+	def summary(self) -> List[str]:
+		"""Lines of a table of time per category and the longest spans."""
+		with self._lock:
+			spans = [event for event in self.events if event["ph"] == "X"]
+
+		categories: Dict[str, List[int]] = {}
+		for event in spans:
+			categories.setdefault(event["cat"], []).append(event["dur"])
+
+		lines = [f"Wall time {self._now() / 1e6:.1f}s", f"{'category':<12} {'count':>6} {'total':>9} {'longest':>9}"]
+		for cat, durations in sorted(categories.items(), key=lambda item: -sum(item[1])):
+			lines += [f"{cat:<12} {len(durations):>6} {sum(durations) / 1e6:>8.1f}s {max(durations) / 1e6:>8.1f}s"]
+
+		lines += ["Longest:"]
+		# Targets and tasks contain the rest, they'd crowd out what they are made of
+		leaves = [event for event in spans if event["cat"] not in ("target", "task")]
+		for event in sorted(leaves, key=lambda event: -event["dur"])[:SUMMARY_SPANS]:
+			where = event.get("args", {}).get("target")
+			lines += [f"{event['dur'] / 1e6:>8.1f}s {event['name']}" + (f" ({where})" if where else "")]
+		return lines
+
+
+# Every span of the run goes here, set up by setup()
+active = Tracer()
+
+
+def setup() -> Tracer:
+	global active
+	active = Tracer()
+	return active
+
+
+def span(name: str, cat: str, **args):
+	"""Time what runs in this context as name, in category cat (download, configure, ...)."""
+	target = current_target()
+	if target is not None:
+		args.setdefault("target", target)
+	return active.span(name, cat, **args)
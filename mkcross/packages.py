@@ -1,98 +1,251 @@
+import contextvars
+import errno
+import fcntl
+import hashlib
+import json
 import os
+import re
 import shutil
-from distutils.dir_util import copy_tree
 import shlex
 import subprocess
+import threading
+import time
 from abc import ABC, abstractmethod
-from pathlib import Path
-from typing import Dict, List
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, List, Optional, Tuple
+import requests
+from mkcross.helper import accounting, jobserver, launcher, mirrors, remote_cache, trace
+from mkcross.helper.artifacts import ArtifactCache
+from mkcross.helper.cas import ChecksumError, ContentStore, HashingWriter, TeeReader
+from mkcross.helper.cmake_cache import CheckCache, read_check_results, write_initial_cache
+from mkcross.helper.dedup import DEDUP_MARKER, DedupStore, unshare_tree
+from mkcross.helper.download import TIMEOUT, download as http_download, local_path, session
+from mkcross.helper.extract import Extractor
 from mkcross.helper.flags import join_map_flags
+from mkcross.helper.install import install_tree
+from mkcross.helper.output import extra_env, log, run
+from mkcross.helper.sourceview import SourceView
+from mkcross.helper.stamps import Stamp
+from mkcross.helper.toolchain import clang_version, inputs_hash
 
 import mkcross.helper.latest_version as latest_ver
 
-import libarchive
-import requests
-from tqdm import tqdm
-
 from mkcross import cfg
 import llvmtarget
 from mkcross.targets.targetmeta import TargetMeta
 
+content_store = ContentStore(cfg.dlpath)
+extractor = Extractor(cfg.extract_jobs)
+artifact_cache = ArtifactCache(cfg.cachepath / "artifacts")
+dedup_store = DedupStore(cfg.cachepath / "dedup")
 
-# TODO verify/skip download
 class Downloader:
 	url: str
 	temppath: Path
-	path: Path
 	filename: str
+	sha256: str
+	immutable: bool
 
-	def __init__(self, url: str, filename: str):
+	# Every download that is running or finished in this process, by url.
+	# This is what lets the prefetcher and the package builds share downloads.
+	_pending: Dict[str, Future] = {}
+	_lock = threading.Lock()
+
+	def __init__(self, url: str, filename: str, sha256: str = None, immutable: bool = True):
 		self.url = url
-		self.path = cfg.dlpath / filename
-		self.temppath = Path(str(self.path) + ".__download__")
 		self.filename = filename
+		# Different urls can share a filename, the store sorts out the real files.
+		urlhash = hashlib.sha256(url.encode()).hexdigest()[:16]
+		self.temppath = cfg.dlpath / (urlhash + "-" + filename + ".__download__")
+		self.sha256 = sha256
+		# Mutable urls (eg branch tarballs) don't get pinned to the first hash seen
+		self.immutable = immutable
+
+	@property
+	def path(self) -> Path:
+		digest = self.sha256 or content_store.pinned(self.url)
+		if digest is None:
+			raise FileNotFoundError(f"{self.url} has not been downloaded")
+		return content_store.object_path(digest)
+
+	def schedule(self, executor: ThreadPoolExecutor = None):
+		"""Get the future for this download, starting it on executor if nobody has yet.
+
+		Returns the future and whether the caller is now responsible for resolving it,
+		which only happens without an executor.
+		"""
+		with Downloader._lock:
+			future = Downloader._pending.get(self.url)
+			if future is not None:
+				return future, False
+
+			future = executor.submit(self.fetch) if executor is not None else Future()
+			Downloader._pending[self.url] = future
+			return future, executor is None
 
-	# TODO resume download
 	def download(self):
+		"""Download the file, or wait for whoever is already downloading it."""
+		future, owned = self.schedule()
+		if not owned:
+			future.result()
+			return
+
+		try:
+			self.fetch()
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		future.set_result(None)
+
+	def cached(self) -> bool:
+		if self.sha256 is not None:
+			return content_store.verify(self.sha256)
+		return content_store.lookup(self.url) is not None
+
+	def fetch(self):
 		# TODO force redownloads option
 		# TODO tqdm, maybe global array of current progress operations
-		if not self.path.exists():
-			print("Downloading " + self.url)
-			resume = self.temppath.exists()
-			headers = {"Range": "bytes=" + str(self.temppath.stat().st_size) + "-"} if resume else {}
-			r = requests.get(self.url, headers=headers, allow_redirects=True, stream=True)
+		if self.cached():
+			log("Already downloaded " + self.url)
+			return
+
+		candidates = mirrors.active.candidates(self.url, self.filename)
+		for i, url in enumerate(candidates):
+			log("Downloading " + self.url + ("" if url == self.url else " from " + url))
+			start = time.monotonic()
+			try:
+				# A partial download from the last mirror is resumed from this one
+				with trace.span("download " + self.filename, "download", url=url):
+					digest, received = http_download(url, self.temppath, "Download " + self.filename, cfg.download_segments)
+				# Only what came from this mirror, not what an earlier attempt left
+				mirrors.active.record(url, received, time.monotonic() - start)
+				content_store.add(self.temppath, digest, self.url, expected=self.sha256, pin=self.immutable)
+				return
+			except (requests.RequestException, OSError, ChecksumError) as e:
+				if i == len(candidates) - 1:
+					raise
+				log(f"[W] Downloading from {url} failed, trying the next mirror: {e}")
+
+	def stream(self, consume: Callable[[TeeReader], None]) -> str:
+		"""Download while consume() reads the response, storing it in the same pass.
+
+		Only call this while holding the download (see schedule()). Returns the digest.
+		"""
+		# No failing over half way here, what was extracted can't be taken back
+		url = mirrors.active.candidates(self.url, self.filename)[0]
+		log("Streaming " + self.url + ("" if url == self.url else " from " + url))
+		src = local_path(url)
+		if src is not None:
+			source = open(src, "rb")
+			size = src.stat().st_size
+		else:
+			r = session().get(url, allow_redirects=True, stream=True, timeout=TIMEOUT)
 			r.raise_for_status()
+			r.raw.decode_content = True
+			source = r.raw
+			size = int(r.headers.get("Content-Length", 0)) or None
+
+		with source, open(self.temppath, "wb") as handle:
+			writer = HashingWriter(handle)
+			tee = TeeReader(source, writer, size)
+			consume(tee)
+			tee.drain()
+
+		digest = writer.hexdigest()
+		content_store.add(self.temppath, digest, self.url, expected=self.sha256, pin=self.immutable)
+		return digest
+
+
+class Prefetcher:
+	"""Downloads files on a bounded thread pool while the build runs.
+
+	Builds don't need to know about this, Downloader.download() just waits for
+	the prefetched file if it is scheduled here.
+	"""
+	executor: ThreadPoolExecutor
+
+	def __init__(self, jobs: int = None):
+		self.executor = ThreadPoolExecutor(max_workers=jobs or cfg.download_jobs, thread_name_prefix="prefetch")
+
+	def prefetch(self, packages: List["PackageMeta"]):
+		"""Start fetching what packages need. Their depends_on has to be filled in, for artifact keys."""
+		for pkg in packages:
+			pkg.prefetch_artifact()
+			# Checking for the artifact can wait for the remote cache, so not here
+			self.executor.submit(contextvars.copy_context().run, self._prefetch, pkg)
+
+	def _prefetch(self, pkg: "PackageMeta"):
+		if not pkg.needs_files():
+			return
+		if cfg.stream_extract and isinstance(pkg, SourcePackage):
+			# Downloads that aren't cached get extracted as they arrive
+			for file in pkg.files.values():
+				pkg.schedule_extract(file)
+			return
+
+		for file in pkg.files.values():
+			if file.downloader is not None:
+				file.downloader.schedule(self.executor)
 
-			if resume:
-				print("Resuming download of " + self.url)
-				try:
-					r.headers["accept-ranges"] # Throw if not exists
-					resume_works = True
-				except KeyError:
-					resume_works = False
-
-			file_size = int(r.headers.get("Content-Length", 0))
-
-			mode = "ab" if resume and resume_works else "wb"
-
-			with open(self.temppath, mode) as handle:
-				for data in tqdm(r.iter_content(chunk_size=8192), total=__import__("math").ceil(file_size/8192), desc="Download " + self.filename):
-					handle.write(data)
-
-			self.temppath.rename(self.path)
-		else:
-			print("Already downloaded " + self.url)
+	def shutdown(self, cancel: bool = False):
+		"""Wait for the downloads, or with cancel only for those already running."""
+		self.executor.shutdown(wait=True, cancel_futures=cancel)
 
 
 class PackageFile:
 	url: str
 	filename: str
-	path: Path
 	# None for non-downloadable files eg macos sdk
 	downloader: Downloader
 	missing_message: str
 
-	def __init__(self, url: str, filename: str = None):
+	def __init__(self, url: str, filename: str = None, sha256: str = None, immutable: bool = True):
 		self.url = url
 		if filename is None:
 			filename = url.split('/')[-1]
-		self.path = cfg.dlpath / filename
 		self.filename = filename
-		if url is not None:
-			self.downloader = Downloader(url, filename)
+		self.downloader = Downloader(url, filename, sha256, immutable) if url is not None else None
+
+	@property
+	def path(self) -> Path:
+		if self.downloader is not None:
+			return self.downloader.path
+		return cfg.dlpath / self.filename
 
 
 class PackageMeta(ABC):
 	files: List[PackageFile]
 	target: TargetMeta
+	# What this package puts in the sysroot, eg "libc", and what it needs there before configure().
+	# The scheduler orders packages by these, see mkcross.scheduler.
+	provides: Tuple[str, ...] = ()
+	requires: Tuple[str, ...] = ()
+	# Rough relative time to build, used to start the longest chains first
+	cost: int = 1
+	# Whether installed files can be kept in the artifact cache, see run_stages()
+	cacheable: bool = True
+	# Whether install() only ever replaces files in the sysroot, and never writes into existing ones
+	installs_by_replacing: bool = False
+	# Where install() puts files instead of the sysroot, while capturing an artifact
+	_install_root: Optional[Path] = None
 	# dep_host_exe: List[str]
-	# TODO dep checking based on class name, check in check method, each package prechecked deps and validity
+	# TODO check in check method, each package prechecked deps and validity
 	def __init__(self, target: TargetMeta, files: [PackageFile]):
 		self.target = target
 
 		self.files = files
+		# Packages providing what this one requires, filled in by the scheduler
+		self.depends_on = []
+
+	def needs_files(self) -> bool:
+		"""Whether this run needs the files at all, False when install() has what it needs cached."""
+		return self.cached_artifact() is None
 
 	def download(self):
+		if not self.needs_files():
+			return
 		for file in self.files.values():
 			if file.downloader is not None:
 				file.downloader.download()
@@ -104,6 +257,9 @@ class PackageMeta(ABC):
 	def prepare(self):
 		pass
 
+	def configure(self):
+		pass
+
 	def build(self):
 		pass
 
@@ -111,6 +267,192 @@ class PackageMeta(ABC):
 	def install(self):
 		return NotImplemented
 
+	@property
+	def stamp_id(self) -> str:
+		return type(self).__name__
+
+	def stage_inputs(self) -> dict:
+		"""Everything the result of this package depends on, for stamps."""
+		target = self.target
+		return {
+			"package": type(self).__name__,
+			"toolchain": clang_version(),
+			"triple": target.llvmtarget.triplestr,
+			"cflags": target.cflags,
+			"cxxflags": target.cxxflags,
+			"ldflags": target.ldflags,
+		}
+
+	@property
+	def install_root(self) -> Path:
+		"""Where install() puts files, the sysroot unless they are being captured."""
+		return self._install_root or self.target.sysroot.resolve()
+
+	def source_ids(self) -> Dict[str, Optional[str]]:
+		"""What identifies each file before it is downloaded, None if only its download does."""
+		ids = {}
+		for filename, file in self.files.items():
+			dl = file.downloader
+			if dl is None:
+				ids[filename] = filename
+			else:
+				# The url of an immutable file stands for its contents
+				ids[filename] = dl.sha256 or (dl.url if dl.immutable else content_store.pinned(dl.url))
+		return ids
+
+	def artifact_key(self) -> str:
+		"""Hash of everything the installed files depend on, wherever the sysroot is.
+
+		Only uses what is known before fetching, so a cache hit can skip the download.
+		"""
+		inputs = {
+			**self.stage_inputs(),
+			"sources": self.source_ids(),
+			"upstream": {dep.stamp_id: dep.artifact_key() for dep in self.depends_on},
+		}
+		text = json.dumps(inputs, sort_keys=True, default=str)
+		# Options spell out the sysroot path, it doesn't end up in what is built
+		for sysroot in sorted({str(self.target.sysroot.resolve()), str(self.target.sysroot)}, key=len, reverse=True):
+			text = text.replace(sysroot, "{sysroot}")
+		return inputs_hash(text)
+
+	def prefetch_artifact(self):
+		"""Start pulling the artifact of this package from the remote cache, if it isn't here yet."""
+		if remote_cache.active is None or not (cfg.artifact_cache and self.cacheable):
+			return
+		if None in self.source_ids().values():
+			# Not downloaded yet, so the key isn't known yet
+			return
+		key = self.artifact_key()
+		if artifact_cache.fetch(key) is None:
+			remote_cache.active.schedule_pull(key, artifact_cache, cfg.artifact_cache_size)
+
+	def cached_artifact(self) -> Optional[Path]:
+		"""The artifact of this package from the local or remote cache, None if there is none."""
+		if not (cfg.artifact_cache and self.cacheable and self.stamp("install") is not None):
+			return None
+		key = self.artifact_key()
+		artifact = artifact_cache.fetch(key)
+		if artifact is None and remote_cache.active is not None:
+			artifact = remote_cache.active.pull(key, artifact_cache, cfg.artifact_cache_size)
+		# Evicted since it was pulled
+		return artifact if artifact is not None and artifact.exists() else None
+
+	@contextmanager
+	def timed(self, stage: str):
+		"""Trace stage, and account the processes it runs to it."""
+		with trace.span(f"{self.stamp_id} {stage}", stage), accounting.stage(self.stamp_id, stage):
+			yield
+
+	def stamp(self, stage: str) -> Optional[Stamp]:
+		"""The stamp of a stage, None if it always runs."""
+		if stage != "install":
+			return None
+		return Stamp(self.target.sysroot / "etc/mkcross/stamps" / (self.stamp_id + ".json"), self.stage_inputs())
+
+	def run_stage(self, stage: str):
+		"""Run configure, build or install, unless its stamp says nothing changed since it last did."""
+		stamp = self.stamp(stage)
+		if stamp is None:
+			with self.timed(stage):
+				getattr(self, stage)()
+			return
+
+		reasons = stamp.changes()
+		if not reasons:
+			log(f"{self.stamp_id}: {stage} is up to date")
+			return
+		if cfg.explain:
+			log(f"{self.stamp_id}: {stage} runs because " + ", ".join(reasons))
+
+		stamp.clear()
+		with self.timed(stage):
+			getattr(self, stage)()
+		stamp.write()
+
+	def run_stages(self):
+		"""configure, build and install, skipping whatever is up to date."""
+		if launcher.active is None:
+			self._run_stages()
+			return
+
+		statslog = cfg.buildpath / (self.target.llvmtarget.triplestr + "-" + self.stamp_id + ".launcher-stats")
+		statslog.unlink(missing_ok=True)
+		with extra_env(launcher.active.env(statslog)):
+			self._run_stages()
+
+		stats = launcher.active.stats(statslog)
+		if stats is not None and sum(stats) > 0:
+			hits, misses = stats
+			log(f"{self.stamp_id}: compiler cache {hits} hits, {misses} misses ({100 * hits // (hits + misses)}%)")
+
+	def _run_stages(self):
+		install = self.stamp("install")
+		if install is not None and not install.changes():
+			log(f"{self.stamp_id} is up to date")
+			return
+
+		# Installing through a staging directory is what lets the artifact and dedup stores see the files
+		if not ((cfg.artifact_cache or cfg.dedup) and self.cacheable and install is not None):
+			if not self.installs_by_replacing and (self.target.sysroot / DEDUP_MARKER).exists():
+				# Writing into a file the dedup store shares would change it in every sysroot
+				unshare_tree(self.install_root)
+				(self.target.sysroot / DEDUP_MARKER).unlink()
+			for stage in ["configure", "build", "install"]:
+				self.run_stage(stage)
+			return
+
+		staging = cfg.buildpath / (self.target.llvmtarget.triplestr + "-" + self.stamp_id + ".install")
+		shutil.rmtree(staging, ignore_errors=True)
+		staging.mkdir(parents=True)
+		try:
+			self._install_staged(staging, install)
+		finally:
+			shutil.rmtree(staging, ignore_errors=True)
+
+	def _install_staged(self, staging: Path, install: Stamp):
+		key = self.artifact_key() if cfg.artifact_cache else None
+		with trace.span(f"{self.stamp_id} pull", "cache"):
+			artifact = self.cached_artifact()
+
+		install.clear()
+		if artifact is not None:
+			log(f"{self.stamp_id}: restoring {key[:16]} from the artifact cache")
+			with trace.span(f"{self.stamp_id} restore", "cache"):
+				extractor.extract_file(artifact, self.install_root if not cfg.dedup else staging, self.stamp_id)
+			if not cfg.dedup:
+				install.write()
+				return
+		else:
+			# Skipped if the artifact was there when fetching, and is gone now
+			self.download()
+			self.prepare()
+			self.run_stage("configure")
+			self.run_stage("build")
+
+			# Install on the side, so exactly what install() wrote gets captured
+			self._install_root = staging
+			try:
+				with self.timed("install"):
+					self.install()
+			finally:
+				self._install_root = None
+
+			if cfg.artifact_cache:
+				with trace.span(f"{self.stamp_id} store", "cache"):
+					artifact = artifact_cache.store(key, staging, cfg.artifact_cache_size)
+				log(f"{self.stamp_id}: stored {key[:16]} in the artifact cache")
+				if remote_cache.active is not None:
+					remote_cache.active.push(key, artifact)
+
+		if cfg.dedup:
+			with trace.span(f"{self.stamp_id} dedup", "dedup"):
+				dedup_store.add_tree(staging, jobs=cfg.extract_jobs)
+			(self.target.sysroot / DEDUP_MARKER).touch()
+		with trace.span(f"{self.stamp_id} install_tree", "install"):
+			install_tree(staging, self.install_root, cfg.extract_jobs, link=cfg.dedup)
+		install.write()
+
 
 class SourcePackage(PackageMeta):
 	files: List[PackageFile]
@@ -128,25 +470,107 @@ class SourcePackage(PackageMeta):
 		self.builddir = Path(cfg.buildpath / (target.llvmtarget.triplestr + '-' + self.name + '-' + self.ver))
 		self.builddir.mkdir(parents=True, exist_ok=True)
 
-	def prepare(self):
-		# TODO threads
-		# TODO move this logic somewhere else so same filenames are ok
+	def download(self):
+		# prepare() fetches whatever it streams
+		if not cfg.stream_extract:
+			super().download()
+
+	@property
+	def stamp_id(self) -> str:
+		return self.name
+
+	def build_options(self) -> dict:
+		"""Options of the package itself that change what it builds."""
+		return {}
+
+	def stage_inputs(self) -> dict:
+		sources = {}
+		for filename, file in self.files.items():
+			dl = file.downloader
+			sources[filename] = (dl.sha256 or content_store.pinned(dl.url)) if dl is not None else filename
+		return {
+			**super().stage_inputs(),
+			"version": self.ver,
+			"sources": sources,
+			"options": self.build_options(),
+		}
 
-		# https://bugs.python.org/issue40358
-		src = Path(os.path.relpath(cfg.srcpath))
-		for file in self.files.values():
-			extractcheckpath = cfg.srcpath / ("." + file.filename + ".__extracted__")
-			if not extractcheckpath.exists():
-				with tqdm(total=file.path.stat().st_size, desc="Extract " + file.filename) as bar, \
-					libarchive.file_reader(str(file.path)) as archive:
-					for entry in archive:
+	def stamp_path(self, stage: str) -> Path:
+		if stage == "install":
+			# A fresh sysroot needs installing again
+			return self.target.sysroot / "etc/mkcross/stamps" / (self.stamp_id + ".json")
+		return self.builddir / ".mkcross-stamps" / f"{self.stamp_id}.{stage}.json"
+
+	def stamp(self, stage: str) -> Optional[Stamp]:
+		upstream = {dep.stamp_id: dep.stamp("install").digest for dep in self.depends_on}
+		configure = {**self.stage_inputs(), "upstream": upstream}
+		if launcher.active is not None:
+			# Doesn't change what is built, but configure remembers it
+			configure["launcher"] = launcher.active.path
+
+		if stage == "configure":
+			inputs = configure
+		elif stage == "build":
+			inputs = {"configure": inputs_hash(configure)}
+		elif stage == "install":
+			inputs = {"configure": inputs_hash(configure), "sysroot": str(self.target.sysroot.resolve())}
+		else:
+			return None
+		return Stamp(self.stamp_path(stage), inputs)
+
+	def schedule_extract(self, file: PackageFile) -> Future:
+		"""Start extracting file into the sources directory.
+
+		With cfg.stream_extract, a file nobody has downloaded yet is extracted
+		straight from the network while it is stored.
+		"""
+		include = self.extract_filter()
+		# A partial extraction doesn't do for someone who wants it all
+		extractcheckpath = cfg.srcpath / ("." + file.filename + (".partial" if include is not None else "") + ".__extracted__")
+		dl = file.downloader
+		# If the pinned archive was extracted, no need to even have it
+		stamp = (dl.sha256 or content_store.pinned(dl.url)) if dl is not None else file.path.name
+
+		def job():
+			if dl is not None:
+				future, owned = dl.schedule()
+				if owned and cfg.stream_extract and not dl.cached():
+					try:
 						# TODO read extractdir for packages that are stupid
-						entry.pathname = str(src / entry.pathname)
-						libarchive.extract.extract_entries([entry])
-						bar.update(archive.bytes_read - bar.n)
-					extractcheckpath.touch()
-			else:
-				print("Already extracted " + file.filename)
+						with trace.span("stream+extract " + file.filename, "extract"):
+							digest = dl.stream(lambda s: extractor.extract_stream(s, cfg.srcpath, file.filename, s.size, include))
+					except BaseException as e:
+						future.set_exception(e)
+						raise
+					future.set_result(None)
+					return digest
+
+				if owned:
+					try:
+						dl.fetch()
+					except BaseException as e:
+						future.set_exception(e)
+						raise
+					future.set_result(None)
+				else:
+					future.result()
+
+			with trace.span("extract " + file.filename, "extract"):
+				extractor.extract_file(file.path, cfg.srcpath, file.filename, include)
+			return file.path.name
+
+		return extractor.schedule(extractcheckpath, stamp, file.filename, job)
+
+	def extract_filter(self) -> Optional[Callable[[PurePosixPath], bool]]:
+		"""Which archive paths to extract, None for everything."""
+		return None
+
+	def prepare(self):
+		if not self.needs_files():
+			return
+		# All archives of the package extract at the same time
+		for job in [self.schedule_extract(file) for file in self.files.values()]:
+			job.result()
 
 	def configure(self):
 		pass
@@ -159,22 +583,32 @@ class SourcePackage(PackageMeta):
 	def install(self):
 		return NotImplemented
 
+	def compiler(self, name: str) -> List[str]:
+		"""The command for compiler name, through the compiler launcher if there is one."""
+		compiler = shutil.which(name)
+		return launcher.active.wrap(compiler) if launcher.active is not None else [compiler]
+
 	def make(self, *targets, dir: Path = None, prog: str = "make", check = True):
 		if dir is None:
 			dir = self.builddir
 		cmd = [prog] + cfg.makeopts + ["-C", str(dir), *targets]
-		print("[I] Running", shlex.join(cmd))
-		subprocess.run(cmd, check=check),
+		run(cmd, check=check)
 
 
 class Linux(SourcePackage):
 	headers_only: bool
+	provides = ("kernel-headers",)
+	# install() copies the headers over from the cache
+	installs_by_replacing = True
+	# Directories of the kernel tree headers_install needs
+	HEADERS_INSTALL_DIRS = ("arch", "include", "scripts", "tools", "usr")
+
+	def build_options(self):
+		return {"headers_only": self.headers_only}
 
 	@staticmethod
 	def get_latest_version():
-		r = requests.get("https://www.kernel.org/releases.json")
-		r.raise_for_status()
-		return r.json()["latest_stable"]["version"]
+		return latest_ver.linux()
 
 	# alpha, h8300, ia64, microblaze, nds32, nios2, openrisc, parisc, sh, are not implemented or were removed from LLVM
 	@staticmethod
@@ -211,29 +645,85 @@ class Linux(SourcePackage):
 		}
 		super().__init__(target, files, "linux", ver)
 
+	@property
+	def headers_cache(self) -> Path:
+		"""Where the installed UAPI headers are kept, they are the same for every target with this kernel ARCH."""
+		return cfg.cachepath / "linux-headers" / f"{self.ver}-{Linux.arch_for_llvm(self.target.llvmtarget)}"
+
+	def needs_files(self) -> bool:
+		return not (self.headers_only and self.headers_cache.exists()) and super().needs_files()
+
+	def extract_filter(self):
+		if not self.headers_only:
+			return None
+		# headers_install only reads these (and the top level files), the rest is most of the tarball
+		return lambda path: len(path.parts) <= 2 or path.parts[1] in Linux.HEADERS_INSTALL_DIRS
+
 	def build(self):
 		if not self.headers_only:
 			pass
-	
-	def install(self):
-		if self.headers_only:
+
+	def uapi_headers(self) -> Path:
+		"""The installed UAPI headers, from the cache or installed into it now."""
+		cached = self.headers_cache
+		cached.parent.mkdir(parents=True, exist_ok=True)
+		# The cache is shared with other mkcross processes, the lock file keeps them from installing it at the same time
+		with uapi_headers_lock(cached), open(cached.with_name(cached.name + ".lock"), "w") as lockfile:
+			fcntl.flock(lockfile, fcntl.LOCK_EX)
+			if cached.exists():
+				log(f"Using cached UAPI headers {cached.name}")
+				return cached
+
+			# The sources were skipped if the headers were cached when the run started
+			self.download()
+			self.prepare()
+
+			arch = Linux.arch_for_llvm(self.target.llvmtarget)
+			# One object directory per arch, so arches install from the one source tree at the same time
+			objdir = cfg.buildpath / f"linux-{self.ver}-headers-{arch}"
+			objdir.mkdir(parents=True, exist_ok=True)
+			tmp = cached.with_name(cached.name + f".{os.getpid()}.tmp")
+			shutil.rmtree(tmp, ignore_errors=True)
 			self.make("headers_install",
-				"ARCH=" + Linux.arch_for_llvm(self.target.llvmtarget),
-				"O=" + str(self.builddir),
-				"INSTALL_HDR_PATH=" + str(self.target.sysroot.resolve()),
+				"ARCH=" + arch,
+				"O=" + str(objdir),
+				"INSTALL_HDR_PATH=" + str(tmp),
 				dir=self.srcdir)
+			try:
+				os.replace(tmp, cached)
+			except OSError as e:
+				# A process that doesn't lock got there first, theirs is as good
+				if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+					raise
+				shutil.rmtree(tmp, ignore_errors=True)
+			return cached
+
+	def install(self):
+		if self.headers_only:
+			install_tree(self.uapi_headers(), self.install_root, cfg.extract_jobs)
 		#will only be not headers only if target specifies build kernel
 
 
 class WasixLibc(SourcePackage):
+	provides = ("libc-headers", "libc")
+	requires = ("resource-headers",)
+	cost = 3
+	# Builds straight into the sysroot, there is no install() to capture
+	cacheable = False
+
 	def __init__(self, target: TargetMeta):
 		files = {
-			"wasix-libc.tar.gz": PackageFile("https://github.com/wasix-org/wasix-libc/archive/main.tar.gz")
+			"wasix-libc.tar.gz": PackageFile("https://github.com/wasix-org/wasix-libc/archive/main.tar.gz", immutable=False)
 		}
 		super().__init__(target, files, "wasix-libc", "main")
 
+	def stamp_path(self, stage: str) -> Path:
+		# Builds straight into the sysroot, so a fresh one needs everything again
+		return self.target.sysroot / "etc/mkcross/stamps" / f"{self.stamp_id}.{stage}.json"
+
 	def configure(self):
-		copy_tree(str(self.srcdir), str(self.builddir))
+		# The makefile builds next to the sources, only what changed since last time gets cloned
+		SourceView(self.srcdir, self.builddir).sync()
 
 		# Make sure we use our own libclang_rt:
 		(self.builddir / "libclang_rt.builtins-wasm32.a").unlink(missing_ok=True)
@@ -246,7 +736,7 @@ class WasixLibc(SourcePackage):
 		cflags.remove("-D_WASI_EMULATED_PROCESS_CLOCKS")
 
 		self.make(
-			f"CC={shutil.which('clang')}",
+			"CC=" + shlex.join(self.compiler("clang")),
 			f"AR={shutil.which('llvm-ar')}",
 			f"NM={shutil.which('llvm-nm')}",
 			"EXTRA_CFLAGS=" + join_map_flags(cflags, self.target.sysroot),
@@ -264,9 +754,16 @@ class WasixLibc(SourcePackage):
 
 class Musl(SourcePackage):
 	headers_only: bool
+	provides = ("libc",)
+	requires = ("resource-headers", "libc-headers", "kernel-headers", "compiler-rt")
+	cost = 3
 
 	def __init__(self, target: TargetMeta, ver: str = None, headers_only=False):
 		self.headers_only = headers_only
+		if headers_only:
+			self.provides = ("libc-headers",)
+			self.requires = ("resource-headers",)
+			self.cost = 1
 		url = f"https://musl.libc.org/releases/musl-{ver}.tar.gz"
 		files = {
 			f"musl-{ver}.tar.gz": PackageFile(url),
@@ -277,6 +774,14 @@ class Musl(SourcePackage):
 	def get_latest_version():
 		return latest_ver.git("https://git.musl-libc.org/git/musl")[1:]
 
+	@property
+	def stamp_id(self) -> str:
+		# Both passes share a build directory, but each has its own stamps
+		return "musl-headers" if self.headers_only else "musl"
+
+	def build_options(self):
+		return {"headers_only": self.headers_only}
+
 	def configure(self):
 		# TODO default buildpath and srcpath in thing
 		# TODO env to target or sourcepackage
@@ -284,7 +789,7 @@ class Musl(SourcePackage):
 		LIBCC = subprocess.check_output(CC + ["-print-libgcc-file-name"])
 		env = {
 			# Put target and stuff in CC because try_ldflag doesn't respect CFLAGS and will try add lgcc_eh because it exists on the host
-			"CC": shlex.join(CC),
+			"CC": shlex.join(CC if launcher.active is None else launcher.active.wrap(CC[0]) + CC[1:]),
 			"LIBCC": LIBCC,
 			"AR": shutil.which("llvm-ar"),
 			"RANLIB": shutil.which("llvm-ranlib"),
@@ -292,7 +797,7 @@ class Musl(SourcePackage):
 			# fix for LTO: https://www.openwall.com/lists/musl/2021/01/29/4
 			"LDFLAGS": join_map_flags(self.target.ldflags, self.target.sysroot) + " -u __dls2",
 		}
-		subprocess.run([str((self.srcdir / "configure").resolve()), "--disable-gcc-wrapper", "--target=" + self.target.llvmtarget.triplestr, "--prefix=/"], env=env, cwd=self.builddir, check=True)
+		run([str((self.srcdir / "configure").resolve()), "--disable-gcc-wrapper", "--target=" + self.target.llvmtarget.triplestr, "--prefix=/"], env=env, cwd=self.builddir)
 
 	def build(self):
 		self.make("obj/include/bits/alltypes.h")
@@ -301,7 +806,7 @@ class Musl(SourcePackage):
 
 	def install(self):
 		install_target = "install-headers" if self.headers_only else "install"
-		self.make("DESTDIR=" + str(self.target.sysroot.resolve()), install_target)
+		self.make("DESTDIR=" + str(self.install_root), install_target)
 
 		#will only be not headers only if target specifies build kernel
 
@@ -311,13 +816,15 @@ class MesonPackage(SourcePackage):
 		super().__init__(target, files, name, ver, srcdir)
 		self.meson_opts = meson_opts
 
+	def build_options(self):
+		return self.meson_opts
+
 	def configure(self):
 		user_args = [f"-D{k}={v}" for k, v in self.meson_opts.items()]
 
 		args = [
 			"meson",
 			"setup",
-			"--wipe",
 			"-Dprefix=/",
 			"--cross-file",
 			str(self.target.cross_file_meson),
@@ -325,15 +832,30 @@ class MesonPackage(SourcePackage):
 			str(self.srcdir),
 		]
 
+		if launcher.active is not None:
+			# A later cross file overrides the binaries of the target's
+			args += ["--cross-file", str(self.launcher_cross_file())]
+
+		# Stamps only let this run when something changed, so start over
+		if (self.builddir / "meson-private").exists():
+			args += ["--wipe"]
+
 		args += user_args
-		print("[I] Running", shlex.join(args))
-		subprocess.run(args, check=True)
+		run(args)
+
+	def launcher_cross_file(self) -> Path:
+		path = self.builddir / "mkcross-launcher.ini"
+		with open(path, "w") as f:
+			f.write("[binaries]\n")
+			for lang, compiler in [("c", "clang"), ("objc", "clang"), ("cpp", "clang++"), ("objcpp", "clang++")]:
+				f.write(f"{lang} = {self.compiler(compiler)!r}\n")
+		return path
 
 	def build(self):
-		subprocess.run(["ninja", "-C", str(self.builddir)], check=True)
+		run(["ninja", "-C", str(self.builddir)], jobs=jobserver.ninja_jobs())
 
 	def install(self):
-		subprocess.run(["ninja", "-C", str(self.builddir), "install"], env={"DESTDIR": str(self.target.sysroot.resolve())}, check=True),
+		run(["ninja", "-C", str(self.builddir), "install"], jobs=jobserver.ninja_jobs(), env={"DESTDIR": str(self.install_root)})
 
 
 class CMakePackage(SourcePackage):
@@ -341,6 +863,9 @@ class CMakePackage(SourcePackage):
 		super().__init__(target, files, name, ver, srcdir)
 		self.cmake_opts = cmake_opts
 
+	def build_options(self):
+		return self.cmake_opts
+
 	def configure(self):
 		user_args = [f"-D{k}={v}" for k, v in self.cmake_opts.items()]
 
@@ -355,45 +880,137 @@ class CMakePackage(SourcePackage):
 		if self.target.llvmtarget.is_mingw:
 			args += ["-DCMAKE_INSTALL_INCLUDEDIR=/include"]
 
+		if launcher.active is not None:
+			args += [f"-DCMAKE_{lang}_COMPILER_LAUNCHER={launcher.active.path}" for lang in ["C", "CXX"]]
+
+		if cfg.cmake_check_cache:
+			flag_cache, check_cache = self.check_caches()
+			initial_cache = self.builddir / "mkcross-initial-cache.cmake"
+			write_initial_cache(initial_cache, {**check_cache.load(), **flag_cache.load()})
+			args += ["-C", str(initial_cache)]
+
 		args += user_args
-		print("[I] Running", shlex.join(args))
-		subprocess.run(args, check=True)
+		run(args)
+
+		if cfg.cmake_check_cache:
+			flags, checks = read_check_results(self.builddir / "CMakeCache.txt")
+			flag_cache.update(flags)
+			check_cache.update(checks)
+
+	def check_caches(self):
+		"""Where try-compile results are shared, as (compiler flag checks, other checks).
+
+		Flag checks only depend on the compiler and flags, so every runtimes package
+		of a triple that compiles and links the same way shares them. Header and
+		library checks also depend on what is already installed in the sysroot,
+		and so do flag checks when try-compiles link executables.
+		"""
+		target = self.target
+		compiler = [
+			target.llvmtarget.triplestr, clang_version(),
+			target.cflags, target.cxxflags, target.ldflags, target.can_link,
+			*(self.cmake_opts.get(opt) for opt in ["CMAKE_C_FLAGS", "CMAKE_CXX_FLAGS", "CMAKE_EXE_LINKER_FLAGS", "CMAKE_TRY_COMPILE_TARGET_TYPE"]),
+		]
+		# What the providers installed, so a new libc version gets its checks run again.
+		# Their artifact keys rather than stamps, those don't depend on where the sysroot is.
+		installed = {dep.stamp_id: dep.artifact_key() for dep in self.depends_on}
+		# The toolchain file's default, see TargetMeta
+		try_compile = self.cmake_opts.get("CMAKE_TRY_COMPILE_TARGET_TYPE") or ("EXECUTABLE" if target.can_link else "STATIC_LIBRARY")
+		# Linked checks see the libc and crt objects
+		flag_key = inputs_hash(*compiler) if try_compile == "STATIC_LIBRARY" else inputs_hash(*compiler, installed)
+		root = cfg.cachepath / "cmake"
+		return CheckCache(root, flag_key), CheckCache(root, inputs_hash(*compiler, sorted(self.requires), installed))
 
 	def build(self):
-		subprocess.run(["ninja", "-C", str(self.builddir)], check=True)
+		run(["ninja", "-C", str(self.builddir)], jobs=jobserver.ninja_jobs())
 
 	def install(self):
-		subprocess.run(["ninja", "-C", str(self.builddir), "install"], env={"DESTDIR": str(self.target.sysroot.resolve())}, check=True),
+		run(["ninja", "-C", str(self.builddir), "install"], jobs=jobserver.ninja_jobs(), env={"DESTDIR": str(self.install_root)})
+
+
+# autoreconf writes to the shared sources, so one at a time per source tree
+_source_tree_locks: Dict[str, threading.Lock] = {}
+_source_tree_locks_lock = threading.Lock()
+
+
+def source_tree_lock(srcdir: Path) -> threading.Lock:
+	tree = srcdir.resolve().relative_to(cfg.srcpath).parts[0]
+	with _source_tree_locks_lock:
+		return _source_tree_locks.setdefault(tree, threading.RLock())
+
+
+# Targets with the same kernel ARCH wait for the first one to install the headers
+_uapi_headers_locks: Dict[Path, threading.Lock] = {}
+
+
+def uapi_headers_lock(cached: Path) -> threading.Lock:
+	with _source_tree_locks_lock:
+		return _uapi_headers_locks.setdefault(cached, threading.Lock())
+
+
+# configure rewrites its cache file at the end, so one configure at a time per cache
+_autoconf_cache_locks: Dict[Path, threading.Lock] = {}
+
+
+def autoconf_cache_lock(cache_file: Path) -> threading.Lock:
+	with _source_tree_locks_lock:
+		return _autoconf_cache_locks.setdefault(cache_file, threading.Lock())
 
 
 class AutotoolsPackage(SourcePackage):
+	# Private view of the source tree for in-tree builds, see prepare()
+	view: Optional[SourceView]
+
 	def __init__(self, target: TargetMeta, files: Dict[str, PackageFile], name: str, ver: str, autoconf_opts=[], supports_outoftree=True, srcdir: Path = None, prefix: str = None):
 		self.autoconf_opts = autoconf_opts
 		self.supports_outoftree = supports_outoftree
 		self.prefix = prefix or str()
 		super().__init__(target, files, name, ver, srcdir)
 
-	def configure(self, force_autoreconf=False):
-		olddir = os.getcwd()
+		self.view = None
+		if not supports_outoftree:
+			# The whole tree, the package may only be a subdirectory of it
+			tree = cfg.srcpath / self.srcdir.resolve().relative_to(cfg.srcpath).parts[0]
+			self.view = SourceView(tree, self.builddir / "mkcross-source")
 
-		configure_script = self.srcdir / "configure"
-		if not configure_script.exists() or force_autoreconf:
-			subprocess.run(['autoreconf', '--install', '--symlink', '--verbose'], check=True, cwd=self.srcdir)
+	def build_options(self):
+		return {"autoconf_opts": self.autoconf_opts, "prefix": self.prefix}
 
-		if self.supports_outoftree:
-			workdir = self.builddir
-		else:
-			workdir = self.srcdir
-			self.make("distclean", dir=self.srcdir, check=False)
+	@property
+	def workdir(self) -> Path:
+		"""Where configure and make run."""
+		if self.view is None:
+			return self.builddir
+		return self.view.path / self.srcdir.resolve().relative_to(self.view.source)
+
+	def prepare(self):
+		if not self.needs_files():
+			return
+		super().prepare()
+		if self.view is not None:
+			# Other targets build in the same sources, each package gets its own
+			self.view.sync()
+
+	def configure(self, force_autoreconf=False):
+		# autoreconf writes to the sources, which only an in-tree build has to itself
+		srcdir = self.srcdir if self.view is None else self.workdir
+		configure_script = srcdir / "configure"
+		with source_tree_lock(srcdir) if self.view is None else nullcontext():
+			if not configure_script.exists() or force_autoreconf:
+				run(['autoreconf', '--install', '--symlink', '--verbose'], cwd=srcdir)
+
+		workdir = self.workdir
+		if self.view is not None:
+			self.make("distclean", dir=workdir, check=False)
 
 		sysroot = self.target.sysroot
 
 		configure_args = [
 			str(configure_script),
-			f'CC={shutil.which("clang")}',
+			f'CC={shlex.join(self.compiler("clang"))}',
 			f'AS={shutil.which("clang")}',
 			f'ASFLAGS={join_map_flags(self.target.cflags, sysroot)}',
-			f'CXX={shutil.which("clang++")}',
+			f'CXX={shlex.join(self.compiler("clang++"))}',
 			f'CFLAGS={join_map_flags(self.target.cflags, sysroot)}',
 			f'CXXFLAGS={join_map_flags(self.target.cxxflags, sysroot)}',
 			f'LDFLAGS={join_map_flags(self.target.ldflags, sysroot)}',
@@ -405,22 +1022,43 @@ class AutotoolsPackage(SourcePackage):
 			f'--prefix={self.prefix}',
 		] + self.autoconf_opts
 
-		print("[I] Running", shlex.join(configure_args))
-
-		subprocess.run(configure_args, cwd=workdir)
+		# A failed configure has to raise, or its stamp would say it is up to date
+		if not cfg.autoconf_cache:
+			run(configure_args, cwd=workdir)
+			return
+
+		cache_file = self.autoconf_cache(configure_args)
+		with autoconf_cache_lock(cache_file):
+			cached = cache_file.exists()
+			p = run(configure_args + [f"--cache-file={cache_file}"], check=not cached, cwd=workdir)
+			if p.returncode != 0:
+				log("[W] configure failed with a cache, retrying without it")
+				cache_file.unlink(missing_ok=True)
+				if self.view is not None:
+					self.make("distclean", dir=workdir, check=False)
+				run(configure_args + [f"--cache-file={cache_file}"], cwd=workdir)
+
+	def autoconf_cache(self, configure_args: List[str]) -> Path:
+		"""config.cache shared by every configure for the same host, compiler and flags."""
+		inputs = [arg for arg in configure_args if re.match(r"^[A-Z]+=", arg) or arg.startswith("--host=")]
+		cachedir = cfg.cachepath / "autoconf"
+		cachedir.mkdir(parents=True, exist_ok=True)
+		return cachedir / (inputs_hash(clang_version(), inputs) + ".cache")
 
 	def build(self):
-		self.make(dir=self.builddir if self.supports_outoftree else self.srcdir)
+		self.make(dir=self.workdir)
 
 	def install(self, destdir=None):
-		destdir = str(destdir or self.target.sysroot.resolve())
-		dir = self.builddir if self.supports_outoftree else self.srcdir
-		self.make("DESTDIR=" + destdir, "install", dir=dir)
+		destdir = str(destdir or self.install_root)
+		self.make("DESTDIR=" + destdir, "install", dir=self.workdir)
 
 
 
 
 class MingwHeaders(AutotoolsPackage):
+	provides = ("libc-headers",)
+	requires = ("resource-headers",)
+
 	def __init__(self, target: TargetMeta, ver: str):
 		files = {
 			f"mingw-w64-v{ver}.tar.bz2": PackageFile(f"https://versaweb.dl.sourceforge.net/project/mingw-w64/mingw-w64/mingw-w64-release/mingw-w64-v{ver}.tar.bz2")
@@ -431,6 +1069,10 @@ class MingwHeaders(AutotoolsPackage):
 
 
 class Mingw(AutotoolsPackage):
+	provides = ("libc",)
+	requires = ("resource-headers", "libc-headers")
+	cost = 5
+
 	def __init__(self, target: TargetMeta, ver: str):
 		files = {
 			f"mingw-w64-v{ver}.tar.bz2": PackageFile(f"https://versaweb.dl.sourceforge.net/project/mingw-w64/mingw-w64/mingw-w64-release/mingw-w64-v{ver}.tar.bz2")
@@ -457,7 +1099,7 @@ class Mingw(AutotoolsPackage):
 		super().install(destdir=self.builddir)
 
 		
-		copy_tree(str(self.builddir / self.__mingw_libdir), str(self.target.sysroot / "lib"))
+		install_tree(self.builddir / self.__mingw_libdir, self.install_root / "lib", cfg.extract_jobs)
 		
 		
 		# Multilib:
@@ -482,12 +1124,16 @@ class Mingw(AutotoolsPackage):
         #
 		## Only native is built when no multilib
 		#if arch == arch32 or supports_multilib:
-		#	copy_tree(self.builddir / lib32, self.target.sysroot / (arch32.name + "-w64-mingw32") / "lib")
+		#	install_tree(self.builddir / lib32, self.target.sysroot / (arch32.name + "-w64-mingw32") / "lib")
         #
 		#if arch == arch64 or supports_multilib:
-		#	copy_tree(self.builddir / lib64, self.target.sysroot / (arch64.name + "-w64-mingw32") / "lib")
+		#	install_tree(self.builddir / lib64, self.target.sysroot / (arch64.name + "-w64-mingw32") / "lib")
 
 class PicoLibc(MesonPackage):
+	provides = ("libc-headers", "libc")
+	requires = ("resource-headers",)
+	cost = 3
+
 	@staticmethod
 	def get_latest_version():
 		return latest_ver.github("picolibc/picolibc")
@@ -504,6 +1150,9 @@ class PicoLibc(MesonPackage):
 
 
 class CppWinRT(CMakePackage):
+	requires = ("resource-headers", "libc", "compiler-rt", "unwind", "cxx")
+	cost = 2
+
 	def __init__(self, target: TargetMeta, ver: str):
 		files = {
 			f"cppwinrt-{ver}.tar.gz": PackageFile(f"https://github.com/microsoft/cppwinrt/archive/refs/tags/{ver}.tar.gz", filename=f"cppwinrt-{ver}.tar.gz"),
@@ -516,6 +1165,10 @@ class CppWinRT(CMakePackage):
 
 
 class CompilerRT(CMakePackage):
+	provides = ("compiler-rt",)
+	requires = ("resource-headers", "libc-headers", "kernel-headers")
+	cost = 3
+
 	def __init__(self, target: TargetMeta, ver: str):
 		files = {
 			f"llvmorg-{ver}.tar.gz": PackageFile(f"https://github.com/llvm/llvm-project/archive/refs/tags/llvmorg-{ver}.tar.gz"),
@@ -556,24 +1209,35 @@ class CompilerRT(CMakePackage):
 
 # mm_malloc.h, compiler intrinsics, etc
 class ClangResourceHeaders(PackageMeta):
+	provides = ("resource-headers",)
+	# Copying is all it does
+	cacheable = False
+	installs_by_replacing = True
+
 	def __init__(self, target: TargetMeta):
-		super().__init__(target, [])
+		super().__init__(target, {})
+
+	def stage_inputs(self) -> dict:
+		# Sysroots from when the headers were hardlinked to the host's get copies
+		return {**super().stage_inputs(), "copied": True}
 
 	def install(self):
 		p = subprocess.run(['clang','-print-resource-dir'], capture_output=True, check=True, text=True)
 		system_resources = Path(p.stdout[:-1])
-		copy_tree(str(system_resources / "include"), str(self.target.sysroot / "lib/clang/include"))
+		# Copied, not linked: an edit in the sysroot mustn't change the host compiler
+		install_tree(system_resources / "include", self.install_root / "lib/clang/include", cfg.extract_jobs)
 
 
 class Libunwind(CMakePackage):
-	# TODO: patch to make work with wasix
-	def __init__(self, target: TargetMeta, ver: str):
-		files = {
-			f"llvmorg-{ver}.tar.gz": PackageFile(f"https://github.com/llvm/llvm-project/archive/refs/tags/llvmorg-{ver}.tar.gz"),
-		}
-		srcdir = Path(cfg.srcpath / ("llvm-project-llvmorg-" + ver) / "runtimes")
-		cxxflags = target.cxxflags.copy()
-		
+	provides = ("unwind",)
+	requires = ("resource-headers", "libc", "compiler-rt")
+	cost = 2
+
+	@staticmethod
+	def runtime_options(target: TargetMeta):
+		"""CMake options for libunwind, and compile flags it needs on top of the target's."""
+		cxxflags = []
+
 		if target.llvmtarget.is_baremetal:
 			# alloca.h is included with stdlib.h only when __STRICT_ANSI__ is unset...
 			# also not including stdlib.h makes clang complain about missing size_t
@@ -592,8 +1256,6 @@ class Libunwind(CMakePackage):
 			"CMAKE_EXE_LINKER_FLAGS": join_map_flags(target.ldflags, target.sysroot) + ' --unwindlib=none -nostdlib++',
 			# This makes it too optimistic, and it tries to link lgcc and lgcc_s.
 			#"CMAKE_TRY_COMPILE_TARGET_TYPE": "STATIC_LIBRARY",
-
-			"CMAKE_CXX_FLAGS": join_map_flags(cxxflags, target.sysroot),
 		}
 		if target.llvmtarget.is_baremetal:
 			# LLVM uses this to test if linker script is available: 
@@ -606,20 +1268,31 @@ class Libunwind(CMakePackage):
 		if target.llvmtarget.is_mingw or target.llvmtarget.is_baremetal or target.llvmtarget.is_wasm:
 			opts["LIBUNWIND_ENABLE_SHARED"] = "OFF"
 
-		if target.llvmtarget.is_wasm:
-			_LIBUNWIND_USE_DLADDR
-
-		super().__init__(target, files, "llvm-libunwind", ver, opts, srcdir)
-
-
+		return opts, cxxflags
 
-class LibCXX(CMakePackage):
+	# TODO: patch to make work with wasix
 	def __init__(self, target: TargetMeta, ver: str):
 		files = {
 			f"llvmorg-{ver}.tar.gz": PackageFile(f"https://github.com/llvm/llvm-project/archive/refs/tags/llvmorg-{ver}.tar.gz"),
 		}
 		srcdir = Path(cfg.srcpath / ("llvm-project-llvmorg-" + ver) / "runtimes")
-		cxxflags = target.cxxflags.copy()
+
+		opts, cxxflags = Libunwind.runtime_options(target)
+		opts["CMAKE_CXX_FLAGS"] = join_map_flags(target.cxxflags + cxxflags, target.sysroot)
+
+		super().__init__(target, files, "llvm-libunwind", ver, opts, srcdir)
+
+
+
+class LibCXX(CMakePackage):
+	provides = ("cxx",)
+	requires = ("resource-headers", "libc", "compiler-rt", "unwind")
+	cost = 5
+
+	@staticmethod
+	def runtime_options(target: TargetMeta):
+		"""CMake options for libc++abi and libc++, and compile flags they need on top of the target's."""
+		cxxflags = []
 
 		opts = {
 			"LLVM_ENABLE_RUNTIMES": "libcxxabi;libcxx",
@@ -652,8 +1325,6 @@ class LibCXX(CMakePackage):
 			# strtoll_l, strtoull_l, strtof_l, strtod_l, strtold_l needs this.
 			cxxflags += ["-D_GNU_SOURCE=1"]
 
-		opts["CMAKE_CXX_FLAGS"] = join_map_flags(cxxflags, target.sysroot)
-
 
 		if target.llvmtarget.is_mingw or target.llvmtarget.is_baremetal or target.llvmtarget.is_wasm:
 			# https://github.com/llvm/llvm-project/blob/0bc0edb847a0cc473a8b005c4725948de3306a20/libcxx/cmake/caches/MinGW.cmake
@@ -675,11 +1346,54 @@ class LibCXX(CMakePackage):
 				opts["LIBCXX_INSTALL_LIBRARY_DIR"] = f"/lib/{target.llvmtarget.arch}-wasi"
 				opts["LIBCXXABI_INSTALL_LIBRARY_DIR"] = f"/lib/{target.llvmtarget.arch}-wasi"
 
+		return opts, cxxflags
+
+	def __init__(self, target: TargetMeta, ver: str):
+		files = {
+			f"llvmorg-{ver}.tar.gz": PackageFile(f"https://github.com/llvm/llvm-project/archive/refs/tags/llvmorg-{ver}.tar.gz"),
+		}
+		srcdir = Path(cfg.srcpath / ("llvm-project-llvmorg-" + ver) / "runtimes")
+
+		opts, cxxflags = LibCXX.runtime_options(target)
+		opts["CMAKE_CXX_FLAGS"] = join_map_flags(target.cxxflags + cxxflags, target.sysroot)
 
 		super().__init__(target, files, "llvm-libcxx", ver, opts, srcdir)
 
 
+class LLVMRuntimes(CMakePackage):
+	"""libunwind, libc++abi and libc++ in one configure and one ninja graph.
+
+	Saves a whole runtimes configure. Targets without libunwind (wasm) need
+	the separate Libunwind and LibCXX packages.
+	"""
+	provides = ("unwind", "cxx")
+	requires = ("resource-headers", "libc", "compiler-rt")
+	cost = 6
+
+	def __init__(self, target: TargetMeta, ver: str):
+		files = {
+			f"llvmorg-{ver}.tar.gz": PackageFile(f"https://github.com/llvm/llvm-project/archive/refs/tags/llvmorg-{ver}.tar.gz"),
+		}
+		srcdir = Path(cfg.srcpath / ("llvm-project-llvmorg-" + ver) / "runtimes")
+
+		unwind_opts, unwind_cxxflags = Libunwind.runtime_options(target)
+		cxx_opts, cxx_cxxflags = LibCXX.runtime_options(target)
+
+		opts = {**unwind_opts, **cxx_opts}
+		opts["LLVM_ENABLE_RUNTIMES"] = "libunwind;libcxxabi;libcxx"
+		# libunwind isn't in the sysroot yet when the try compiles run
+		opts["CMAKE_EXE_LINKER_FLAGS"] = unwind_opts["CMAKE_EXE_LINKER_FLAGS"]
+		# Where a separate build would put the libunwind headers, CMAKE_INSTALL_INCLUDEDIR is libc++'s now
+		opts["LIBUNWIND_INSTALL_INCLUDE_DIR"] = "include"
+
+		# libunwind's own flags stay out of libc++, and like CMAKE_CXX_FLAGS of a separate build out of its C and assembly.
+		# SHELL: keeps "-include foo.h" from being deduplicated.
+		opts["LIBUNWIND_ADDITIONAL_COMPILE_FLAGS"] = ";".join(f"$<$<COMPILE_LANGUAGE:CXX>:SHELL:{flag}>" for flag in unwind_cxxflags)
+		opts["CMAKE_CXX_FLAGS"] = join_map_flags(target.cxxflags + cxx_cxxflags, target.sysroot)
+
+		super().__init__(target, files, "llvm-runtimes", ver, opts, srcdir)
+
+
 
 # TODO separate package sources from package for eg llvm
-# Also check for exclusive / canbuildmultipleatsametime, linux eg can't because it uses in-tree build
 # Also todo run previous stages when install() called
@@ -0,0 +1,149 @@
+import contextvars
+import heapq
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List
+
+from mkcross import cfg
+from mkcross.helper import trace
+from mkcross.packages import PackageMeta
+
+
+class Task:
+	"""One step of one package: fetching it (download, prepare) or building it (configure, build, install)."""
+	pkg: PackageMeta
+	stage: str
+	deps: List["Task"]
+	dependents: List["Task"]
+	# Length of the longest chain of work that has to wait for this task
+	priority: int
+
+	def __init__(self, pkg: PackageMeta, stage: str):
+		self.pkg = pkg
+		self.stage = stage
+		self.deps = []
+		self.dependents = []
+		self.priority = 0
+
+	def __lt__(self, other):
+		# heapq is a min heap, longest critical path first
+		return self.priority > other.priority
+
+	def __repr__(self):
+		return f"{type(self.pkg).__name__}:{self.stage}"
+
+	def after(self, task: "Task"):
+		self.deps += [task]
+		task.dependents += [self]
+
+	def run(self):
+		pkg = self.pkg
+		with trace.span(repr(self), "task"):
+			if self.stage == "fetch":
+				pkg.download()
+				with pkg.timed("prepare"):
+					pkg.prepare()
+			else:
+				# configure to install share a build directory, they can't be split up
+				pkg.run_stages()
+
+
+def link_dependencies(packages: List[PackageMeta]):
+	"""Fill in depends_on: the other packages that provide a role each package requires."""
+	providers: Dict[str, List[PackageMeta]] = {}
+	for pkg in packages:
+		for role in pkg.provides:
+			providers.setdefault(role, []).append(pkg)
+
+	for pkg in packages:
+		pkg.depends_on = []
+		for role in pkg.requires:
+			for provider in providers.get(role, []):
+				if provider is not pkg and provider not in pkg.depends_on:
+					pkg.depends_on += [provider]
+
+
+class Scheduler:
+	"""Runs the packages of a target, each stage as soon as what it needs is installed.
+
+	Packages declare the roles they provide and require (see PackageMeta). A
+	package is configured once every other package that provides one of its
+	required roles is installed; roles nobody provides in this target aren't
+	needed in it. Fetching has no dependencies, so it all starts right away.
+	"""
+	tasks: List[Task]
+
+	def __init__(self, packages: List[PackageMeta], jobs: int = None):
+		self.jobs = jobs or cfg.stage_jobs
+		self.tasks = []
+
+		build_tasks = {}
+		for pkg in packages:
+			fetch = Task(pkg, "fetch")
+			build = Task(pkg, "build")
+			build.after(fetch)
+			build_tasks[pkg] = build
+			self.tasks += [fetch, build]
+
+		link_dependencies(packages)
+		for pkg in packages:
+			for provider in pkg.depends_on:
+				build_tasks[pkg].after(build_tasks[provider])
+
+		self._prioritize()
+
+		# Artifact keys need depends_on, so only now
+		for pkg in packages:
+			pkg.prefetch_artifact()
+
+	def _prioritize(self):
+		# Reverse topological order, so dependents are weighted before their dependencies
+		order = []
+		remaining = {task: len(task.dependents) for task in self.tasks}
+		stack = [task for task, n in remaining.items() if n == 0]
+		while stack:
+			task = stack.pop()
+			order += [task]
+			for dep in task.deps:
+				remaining[dep] -= 1
+				if remaining[dep] == 0:
+					stack += [dep]
+
+		if len(order) != len(self.tasks):
+			cycle = [task for task, n in remaining.items() if n > 0]
+			raise ValueError(f"Package dependencies form a cycle: {cycle}")
+
+		for task in order:
+			cost = task.pkg.cost if task.stage == "build" else 1
+			task.priority = cost + max((dependent.priority for dependent in task.dependents), default=0)
+
+	def run(self):
+		waiting = {task: len(task.deps) for task in self.tasks}
+		ready = [task for task, n in waiting.items() if n == 0]
+		heapq.heapify(ready)
+		running = {}
+		failed = None
+
+		with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix="stage") as executor:
+			while ready or running:
+				while ready and len(running) < self.jobs and failed is None:
+					task = heapq.heappop(ready)
+					# Keep the target's log context in the worker
+					running[executor.submit(contextvars.copy_context().run, task.run)] = task
+
+				if not running:
+					break
+
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in done:
+					task = running.pop(future)
+					if future.exception() is not None:
+						# Let what is running finish, but start nothing new
+						failed = failed or future.exception()
+						continue
+					for dependent in task.dependents:
+						waiting[dependent] -= 1
+						if waiting[dependent] == 0:
+							heapq.heappush(ready, dependent)
+
+		if failed is not None:
+			raise failed
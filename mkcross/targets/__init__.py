@@ -5,8 +5,11 @@ from typing import List
 
 import shlex
 
-from mkcross.helper import latest_version
-from mkcross.packages import CompilerRT, LibCXX, Libunwind, Linux, Musl, MingwHeaders, Mingw, CppWinRT, ClangResourceHeaders, PicoLibc, WasixLibc
+from mkcross import cfg
+from mkcross.helper import latest_version, trace
+from mkcross.helper.flags import parse_bool
+from mkcross.packages import CompilerRT, LibCXX, Libunwind, LLVMRuntimes, Linux, Musl, MingwHeaders, Mingw, CppWinRT, ClangResourceHeaders, PicoLibc, WasixLibc
+from mkcross.scheduler import Scheduler
 from mkcross.targets.targetmeta import TargetMeta
 
 
@@ -189,107 +192,57 @@ set(UNIX 1)
 
 
 	def make(self):
-		pkg = ClangResourceHeaders(self)
-		pkg.install()
+		with trace.span(self.triple_nonnormalized, "target"):
+			Scheduler(self.get_packages_list()).run()
+
+	def get_packages_list(self):
+		if self.packages is not None:
+			return self.packages
+
+		pkgs = [ClangResourceHeaders(self)]
 
 		if self.llvmtarget.is_linux:
 			ver = self.config.get("linux_ver") or Linux.get_latest_version()
-			pkg = Linux(self, ver, headers_only=True)
-			pkg.download()
-			pkg.prepare()
-			pkg.build()
-			pkg.install()
+			pkgs += [Linux(self, ver, headers_only=True)]
 
 			# TODO use install_headers() instead of separate thing
-			ver = self.config.get("musl_ver") or Musl.get_latest_version()
-			pkg = Musl(self, ver, headers_only=True)
-			musl = pkg
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
+			musl_ver = self.config.get("musl_ver") or Musl.get_latest_version()
+			pkgs += [Musl(self, musl_ver, headers_only=True)]
 
 		elif self.llvmtarget.is_mingw:
 			ver = "10.0.0" # TODO: unhardcode
-			pkg = MingwHeaders(self, ver)
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
-
-			pkg = Mingw(self, ver)
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
+			pkgs += [MingwHeaders(self, ver), Mingw(self, ver)]
 
 		elif self.llvmtarget.is_wasm:
-			pkg = WasixLibc(self)
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
+			pkgs += [WasixLibc(self)]
 
 		elif self.llvmtarget.is_baremetal:
 			ver = self.config.get("picolibc_ver") or PicoLibc.get_latest_version()
-			pkg = PicoLibc(self, ver)
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
+			pkgs += [PicoLibc(self, ver)]
 
 
 		ver = self.config.get("llvm_ver") or latest_version.llvm()
 
-		pkg = CompilerRT(self, ver)
-		pkg.download()
-		pkg.prepare()
-		pkg.configure()
-		pkg.build()
-		pkg.install()
+		pkgs += [CompilerRT(self, ver)]
 
 		if self.llvmtarget.is_linux:
-			musl.headers_only = False
-			pkg = musl
-			# Must reconfigure to make it aware of new compiler-rt
-			pkg.configure()
-			pkg.build()
-			pkg.install()
-
-
-		if not self.llvmtarget.is_wasm:
-			pkg = Libunwind(self, ver)
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
+			# Must reconfigure to make it aware of new compiler-rt, so it comes after it
+			pkgs += [Musl(self, musl_ver)]
 
-		pkg = LibCXX(self, ver)
-		pkg.download()
-		pkg.prepare()
-		pkg.configure()
-		pkg.build()
-		pkg.install()
+		combined = self.config.get("combined_runtimes")
+		combined = cfg.combined_runtimes if combined is None else parse_bool(combined)
 
-
-		return
+		if self.llvmtarget.is_wasm:
+			# No libunwind, so nothing to combine
+			pkgs += [LibCXX(self, ver)]
+		elif combined:
+			pkgs += [LLVMRuntimes(self, ver)]
+		else:
+			pkgs += [Libunwind(self, ver), LibCXX(self, ver)]
 
 		# I don't know what this is but it builds
-		if ismingw and self.config.get("build_cppwinrt", False):
-			ver = "2.0.230225.1"
-			pkg = CppWinRT(self, ver)
-			pkg.download()
-			pkg.prepare()
-			pkg.configure()
-			pkg.build()
-			pkg.install()
-
-	def get_packages_list(self):
-		return []
+		if self.llvmtarget.is_mingw and parse_bool(self.config.get("build_cppwinrt", "false")):
+			pkgs += [CppWinRT(self, "2.0.230225.1")]
 
+		self.packages = pkgs
+		return pkgs
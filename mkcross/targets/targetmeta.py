@@ -17,6 +17,9 @@ class TargetMeta(ABC):
 
 	can_link: bool
 
+	# Filled by get_packages_list(), in build order
+	packages: list
+
 	cflags: List[str]
 	cxxflags: List[str]
 	ldflags: List[str]
@@ -35,6 +38,7 @@ class TargetMeta(ABC):
 		self.ldflags = []
 
 		self.config = config
+		self.packages = None
 
 		self.check_sanity_or_throw()
 